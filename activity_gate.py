@@ -0,0 +1,182 @@
+import argparse
+import json
+import logging
+import numpy as np
+from metrics import Counter
+from recording import load_directory
+from ring_buffer import RingBuffer
+
+GATE_WINDOWS = Counter("activity_gate_windows_total", "Windows checked by the activity gate, by result")
+
+# Cheap pre-filter in front of the model.
+#
+# Standing and walking windows are by far the most common and never need
+# the CNN, so each device keeps running sums of three per-sample features
+# over the model window:
+#   magnitude  |(gyX, gyY, gyZ)|
+#   std        standard deviation of the magnitude
+#   jerk       |sample - previous sample|, averaged
+# They are updated as samples arrive, in O(new samples), and a window is
+# only handed to the model when one of them reaches its threshold.
+# Thresholds come from calibrate() on the recordings in datasets/, which
+# picks the tightest ones that still pass `target_recall` of the fall
+# windows there.
+#
+# Usage: python activity_gate.py [--data datasets] [--recall 0.995] [--output activity_gate.json]
+FEATURES = ('magnitude', 'std', 'jerk')
+ACTIVITY_GATE_FILE = "activity_gate.json"
+FALL_LABELS = (2, 3, 4)
+
+# Recompute the running sums from scratch every this many samples, so
+# float rounding cannot build up
+RESYNC_INTERVAL = 4096
+
+# Per-sample magnitude, squared magnitude and jerk for an (n, 3) array;
+# `previous` is the sample before the first one, if any
+def sample_features(samples, previous=None):
+    samples = np.asarray(samples, dtype=np.float64)
+    before = samples[:1] if previous is None else previous[None, :]
+    magnitude = np.sqrt(np.einsum('ij,ij->i', samples, samples))
+    jerk = np.linalg.norm(np.diff(samples, axis=0, prepend=before), axis=1)
+    return np.column_stack([magnitude, magnitude * magnitude, jerk])
+
+# Turn summed (magnitude, magnitude², jerk) over `window` samples into the
+# FEATURES values; works on a single row or an (n, 3) array of sums
+def summarize_sums(sums, window):
+    means = np.asarray(sums, dtype=np.float64) / window
+    std = np.sqrt(np.maximum(means[..., 1] - means[..., 0] ** 2, 0))
+    return np.stack([means[..., 0], std, means[..., 2]], axis=-1)
+
+# Running window features of one device
+class ActivityFeatures:
+    def __init__(self, window_size, capacity):
+        self.window_size = window_size
+        self.rows = RingBuffer(capacity, channels=3, dtype=np.float64)
+        self.sums = np.zeros(3)
+        self.previous = None
+        self._since_resync = 0
+
+    def add_samples(self, samples):
+        rows = sample_features(samples, self.previous)
+        self.previous = np.asarray(samples[-1], dtype=np.float64)
+        n = len(rows)
+        held = min(self.rows.count, self.window_size)
+        if n >= self.window_size:
+            self.sums = rows[-self.window_size:].sum(axis=0)
+        else:
+            leaving = held - min(held, self.window_size - n)
+            if leaving:
+                self.sums -= self.rows.window(held)[:, :leaving].sum(axis=1)
+            self.sums += rows.sum(axis=0)
+        self.rows.append_many(rows)
+
+        self._since_resync += n
+        if self._since_resync >= RESYNC_INTERVAL:
+            self.sums = self.rows.window(min(self.rows.count, self.window_size)).sum(axis=1)
+            self._since_resync = 0
+
+    # FEATURES of the latest window, or None before it is full
+    def values(self):
+        if self.rows.count < self.window_size:
+            return None
+        return summarize_sums(self.sums, self.window_size)
+
+class ActivityGate:
+    def __init__(self, thresholds):
+        self.thresholds = thresholds
+        self._limits = np.array([thresholds[name] for name in FEATURES], dtype=np.float64)
+
+    def passes(self, features):
+        values = features.values()
+        passed = values is None or bool((values >= self._limits).any())
+        GATE_WINDOWS.inc(result="passed" if passed else "skipped")
+        return passed
+
+# Load the gate written by calibrate(), or None when there is none, in
+# which case every window goes to the model
+def load_gate(path=ACTIVITY_GATE_FILE):
+    try:
+        with open(path, 'r') as f:
+            calibration = json.load(f)
+    except FileNotFoundError:
+        logging.warning(f"No activity gate calibration at {path}, running the model on every window")
+        return None
+    logging.info(f"Activity gate thresholds {calibration['thresholds']}, calibrated recall "
+                 f"{calibration['recall']:.4f}, skip rate {calibration['skip_rate']:.4f}")
+    return ActivityGate(calibration['thresholds'])
+
+# FEATURES of every window of one recording that ends on a multiple of
+# `hop` samples, the way windows reach the gate online. With
+# `around_peak` only the windows containing the sample with the largest
+# jerk are kept: in a fall capture those are the ones that hold the fall.
+def window_features(samples, window, hop, around_peak=False):
+    if len(samples) < window:
+        return np.empty((0, len(FEATURES)))
+    rows = sample_features(samples)
+    sums = np.concatenate([np.zeros((1, 3)), np.cumsum(rows, axis=0)])
+    ends = np.arange(window, len(samples) + 1, hop)
+    if around_peak:
+        peak = int(np.argmax(rows[:, 2]))
+        ends = ends[(ends - window <= peak) & (peak < ends)]
+    return summarize_sums(sums[ends] - sums[ends - window], window)
+
+# OR-gate recall on fall windows and skip rate on the others for thresholds
+# set to the `level` quantile of every feature over the fall windows
+def evaluate(falls, others, level):
+    thresholds = np.quantile(falls, level, axis=0)
+    recall = (falls >= thresholds).any(axis=1).mean()
+    skip_rate = 1 - (others >= thresholds).any(axis=1).mean() if len(others) else 0.0
+    return thresholds, recall, skip_rate
+
+# Find the highest quantile level whose thresholds keep recall on the fall
+# windows at or above `target_recall`. The fall windows are those around
+# the impact of each fall recording (a capture also holds quiet seconds
+# before and after the fall, which the gate may skip); every window of the
+# other recordings counts towards the skip rate.
+def calibrate(directory, window=120, hop=20, target_recall=0.995, fall_labels=FALL_LABELS):
+    falls, others = [], []
+    for metadata, samples in load_directory(directory):
+        if int(metadata['label']) in fall_labels:
+            falls.append(window_features(samples, window, hop, around_peak=True))
+        else:
+            others.append(window_features(samples, window, hop))
+    falls = np.concatenate(falls) if falls else np.empty((0, len(FEATURES)))
+    others = np.concatenate(others) if others else np.empty((0, len(FEATURES)))
+    if not len(falls):
+        raise ValueError(f"No fall recordings (labels {fall_labels}) in {directory}")
+
+    best = None
+    for level in np.linspace(0, 0.5, 501):
+        thresholds, recall, skip_rate = evaluate(falls, others, level)
+        if recall < target_recall:
+            break
+        best = thresholds, recall, skip_rate
+    thresholds, recall, skip_rate = best
+    return {
+        'thresholds': dict(zip(FEATURES, thresholds.tolist())),
+        'window': window,
+        'hop': hop,
+        'target_recall': target_recall,
+        'recall': float(recall),
+        'skip_rate': float(skip_rate),
+        'fall_windows': len(falls),
+        'other_windows': len(others),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the activity gate from recorded datasets")
+    parser.add_argument("--data", default="datasets", help="directory of .gyro recordings (convert old JSON captures with recording.py)")
+    parser.add_argument("--window", type=int, default=120)
+    parser.add_argument("--hop", type=int, default=20)
+    parser.add_argument("--recall", type=float, default=0.995, help="fall windows that must pass the gate")
+    parser.add_argument("--fall-labels", type=int, nargs="+", default=list(FALL_LABELS))
+    parser.add_argument("--output", default=ACTIVITY_GATE_FILE)
+    args = parser.parse_args()
+
+    calibration = calibrate(args.data, args.window, args.hop, args.recall, tuple(args.fall_labels))
+    with open(args.output, 'w') as f:
+        json.dump(calibration, f, indent=4)
+    print(f"Thresholds: {calibration['thresholds']}")
+    print(f"Recall on {calibration['fall_windows']} fall windows: {calibration['recall']:.4f}")
+    print(f"Skipped {calibration['skip_rate']:.2%} of {calibration['other_windows']} other windows")
+    print(f"Saved to {args.output}")
@@ -0,0 +1,189 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import uuid
+import paho.mqtt.client as mqtt
+from metrics import Counter, Gauge, Histogram
+
+ALERTS_QUEUED = Gauge("alert_outbox_size", "Alerts waiting in the outbox for an acknowledgement")
+ALERTS_SENT = Counter("alerts_delivered_total", "Alerts acknowledged by the broker")
+ALERTS_DROPPED = Counter("alerts_dropped_total", "Alerts dropped because the outbox was full")
+ALERT_DELIVERY_SECONDS = Histogram("alert_delivery_seconds", "Time from an alert being queued to the broker acknowledging it")
+
+# Delivers fall alerts to the notification broker at least once.
+#
+# publish() only appends the alert to an SQLite outbox on disk and returns,
+# so inference never waits on the broker. A background thread owns the
+# MQTT connection: it keeps up to `max_inflight` alerts published with
+# QoS 1 and deletes each one from the outbox when the broker acknowledges
+# it. When the connection drops, unacknowledged alerts are sent again
+# after reconnecting, with jittered exponential backoff between attempts;
+# alerts queued while the broker is down, or before a restart of this
+# process, are delivered once it is back. Every alert carries a unique id
+# so receivers can drop the duplicates at-least-once delivery can cause.
+#
+# The outbox holds at most `max_outbox` alerts; beyond that the oldest
+# ones are dropped and logged.
+class AlertPublisher:
+    def __init__(self, host, port, topic, outbox_path="alert_outbox.db", max_outbox=10000,
+                 max_inflight=20, min_backoff=0.5, max_backoff=30, keepalive=60):
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.max_outbox = max_outbox
+        self.max_inflight = max_inflight
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.keepalive = keepalive
+        self.dropped = 0
+        self.delivered = 0
+
+        self._db = sqlite3.connect(outbox_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, payload TEXT NOT NULL, queued REAL NOT NULL)")
+        self._db_lock = threading.Lock()
+        self._size = self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        ALERTS_QUEUED.set_function(lambda: self._size)
+
+        self._client = None
+        self._connected = False
+        self._inflight = {}  # mid -> (outbox id, queued time)
+        self._last_sent = 0  # Highest outbox id published on this connection
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="alert-publisher", daemon=True)
+        self._thread.start()
+
+    # Stop after trying to deliver what is queued for up to `timeout`
+    # seconds; anything left stays in the outbox for the next start
+    def stop(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self._size and self._connected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._db_lock:
+            self._db.close()
+
+    # Queue one alert; returns its id
+    def publish(self, device_id, label, confidence, timestamp, **fields):
+        alert = {'id': uuid.uuid4().hex, 'device': device_id, 'label': label,
+                 'confidence': round(float(confidence), 4), 'timestamp': timestamp, **fields}
+        with self._db_lock:
+            self._db.execute("INSERT INTO outbox (payload, queued) VALUES (?, ?)", (json.dumps(alert), time.time()))
+            self._size += 1
+            if self._size > self.max_outbox:
+                excess = self._size - self.max_outbox
+                self._db.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (excess,))
+                self._size -= excess
+                self.dropped += excess
+                ALERTS_DROPPED.inc(excess)
+                logging.error(f"Alert outbox full, dropped {excess} oldest alerts")
+        return alert['id']
+
+    def pending(self):
+        return self._size
+
+    def _run(self):
+        backoff = self.min_backoff
+        while not self._stopped.is_set():
+            if not self._connected:
+                error = "no CONNACK"
+                try:
+                    self._connect()
+                except OSError as e:
+                    error = e
+                if not self._connected:
+                    delay = backoff * random.uniform(0.5, 1.0)
+                    logging.error(f"Failed to connect to alert broker {self.host}:{self.port}, "
+                                  f"retrying in {delay:.1f}s: {error}")
+                    self._stopped.wait(delay)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                backoff = self.min_backoff
+
+            self._send_window()
+            rc = self._client.loop(timeout=0.05)
+            if rc != mqtt.MQTT_ERR_SUCCESS and self._connected:
+                self._on_disconnect(self._client, None, rc)
+        if self._connected:
+            self._client.disconnect()
+        self._close_client()
+
+    # Close the socket of the previous client, which a failed attempt leaves open
+    def _close_client(self):
+        if self._client is None:
+            return
+        client, self._client = self._client, None
+        client.on_disconnect = None
+        client.loop_stop()
+        client.disconnect()
+        client.loop(timeout=0)  # Sends the DISCONNECT, after which paho closes the socket
+
+    # A fresh client per connection, so nothing paho kept from the last
+    # one is resent next to the outbox
+    def _connect(self):
+        self._close_client()
+        self._client = mqtt.Client()
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.max_inflight_messages_set(self.max_inflight)
+        self._client.connect(self.host, self.port, self.keepalive)
+        deadline = time.monotonic() + 5
+        while not self._connected and time.monotonic() < deadline:
+            if self._client.loop(timeout=0.5) != mqtt.MQTT_ERR_SUCCESS:
+                break
+
+    # Publish queued alerts until `max_inflight` are awaiting acknowledgement
+    def _send_window(self):
+        room = self.max_inflight - len(self._inflight)
+        if room <= 0 or not self._size:
+            return
+        with self._db_lock:
+            rows = self._db.execute("SELECT id, payload, queued FROM outbox WHERE id > ? ORDER BY id LIMIT ?",
+                                    (self._last_sent, room)).fetchall()
+        for outbox_id, payload, queued in rows:
+            info = self._client.publish(self.topic, payload, qos=1)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            self._inflight[info.mid] = (outbox_id, queued)
+            self._last_sent = outbox_id
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self._connected = True
+            logging.info(f"Connected to alert broker {self.host}:{self.port}, {self._size} alerts queued")
+        else:
+            logging.error(f"Alert broker refused the connection, return code {rc}")
+
+    def _on_disconnect(self, client, userdata, rc):
+        if not self._connected:
+            return
+        self._connected = False
+        # Unacknowledged alerts are still in the outbox; send them again
+        self._inflight.clear()
+        self._last_sent = 0
+        if rc != 0:
+            logging.error(f"Disconnected from alert broker {self.host}:{self.port} (rc {rc}), "
+                          f"{self._size} alerts queued")
+
+    def _on_publish(self, client, userdata, mid):
+        sent = self._inflight.pop(mid, None)
+        if sent is None:
+            return
+        outbox_id, queued = sent
+        with self._db_lock:
+            deleted = self._db.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,)).rowcount
+            self._size -= deleted
+        self.delivered += 1
+        ALERTS_SENT.inc()
+        ALERT_DELIVERY_SECONDS.observe(time.time() - queued)
@@ -0,0 +1,117 @@
+import logging
+import threading
+from collections import deque
+from metrics import Counter
+
+FALL_EVENTS = Counter("fall_events_total", "Fall events opened per label")
+WINDOWS_MERGED = Counter("fall_windows_merged_total", "Positive windows folded into an already open fall event")
+WINDOWS_SUPPRESSED = Counter("fall_windows_suppressed_total", "Positive windows ignored during the refractory period")
+
+# One fall as seen by the alerting path: every positive window from the one
+# that opened it to the last one before it closed. `label` and `confidence`
+# are those of the most confident window.
+class FallEvent:
+    def __init__(self, device_id, label, confidence, window_time):
+        self.device_id = device_id
+        self.label = label
+        self.confidence = confidence
+        self.start = window_time
+        self.end = window_time
+        self.windows = 1
+
+    def add_window(self, label, confidence, window_time):
+        if confidence > self.confidence:
+            self.label = label
+            self.confidence = confidence
+        self.end = window_time
+        self.windows += 1
+
+# Alert state of one device: the last `n` window verdicts, the open event
+# if any and when the last event ended
+class DeviceAlertState:
+    def __init__(self, n):
+        self.recent = deque(maxlen=n)
+        self.event = None
+        self.last_end = None
+
+# Turns the stream of per-window predictions into fall events.
+#
+# Overlapping windows of one fall all classify as a fall, so instead of
+# alerting on each of them an event is opened once at least `k` of the
+# last `n` windows of a device were positive and extended by the positive
+# windows that follow. It ends when fewer than `k` of the last `n` are
+# positive, or when no window arrived for `max_gap` seconds (see
+# close_stale()). For `refractory` seconds after an event ended, positive
+# windows of that device are ignored.
+#
+# `on_start(event)` is called when an event opens (publish the alert) and
+# `on_end(event)` once it is complete (store it). Times are the window
+# times passed to update(), in seconds.
+class FallEventTracker:
+    def __init__(self, on_start, on_end, k=1, n=1, refractory=5.0, max_gap=2.0):
+        if not 1 <= k <= n:
+            raise ValueError(f"Need 1 <= k <= n, got k={k}, n={n}")
+        self.on_start = on_start
+        self.on_end = on_end
+        self.k = k
+        self.n = n
+        self.refractory = refractory
+        self.max_gap = max_gap
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def update(self, device_id, positive, label, confidence, window_time):
+        with self._lock:
+            state = self._devices.get(device_id)
+            if state is None:
+                state = self._devices[device_id] = DeviceAlertState(self.n)
+            if state.event is not None and window_time - state.event.end > self.max_gap:
+                self._close(state)
+            state.recent.append(positive)
+            agreed = sum(state.recent) >= self.k
+
+            if state.event is not None:
+                if positive:
+                    state.event.add_window(label, confidence, window_time)
+                    WINDOWS_MERGED.inc()
+                if not agreed:
+                    self._close(state)
+                return
+
+            if not positive or not agreed:
+                return
+            if state.last_end is not None and window_time - state.last_end < self.refractory:
+                WINDOWS_SUPPRESSED.inc()
+                return
+            state.event = FallEvent(device_id, label, confidence, window_time)
+            FALL_EVENTS.inc(label=label)
+            self._notify(self.on_start, state.event)
+
+    # End events whose device sent no window for `max_gap` seconds; call
+    # periodically so a belt that goes quiet mid-fall still gets its event
+    # stored
+    def close_stale(self, now):
+        with self._lock:
+            for state in self._devices.values():
+                if state.event is not None and now - state.event.end > self.max_gap:
+                    self._close(state)
+
+    # End all open events, e.g. on shutdown
+    def close_all(self):
+        with self._lock:
+            for state in self._devices.values():
+                if state.event is not None:
+                    self._close(state)
+
+    def _close(self, state):
+        event = state.event
+        state.event = None
+        state.last_end = event.end
+        state.recent.clear()
+        self._notify(self.on_end, event)
+
+    def _notify(self, callback, event):
+        try:
+            callback(event)
+        except Exception as e:
+            logging.error(f"Error handling fall event of device {event.device_id}: {e}")
@@ -1,7 +1,18 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from psycopg2 import connect, sql
+from psycopg2 import sql
 import psycopg2.extras
+import psycopg2.pool
+import base64
+import itertools
+import json
+import logging
+import queue
+import random
+import select
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 app = Flask(__name__)
@@ -13,15 +24,156 @@ DB_PASSWORD = "123"
 DB_HOST = "localhost"
 DB_PORT = "5432"
 
-def get_db_connection():
-    conn = connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
-    return conn
+# Connections shared by all routes; opened on first use
+DB_POOL_SIZE = 10
+db_pool = psycopg2.pool.ThreadedConnectionPool(
+    0, DB_POOL_SIZE,
+    dbname=DB_NAME,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    host=DB_HOST,
+    port=DB_PORT
+)
+
+# Page size for /fall_events when no limit is given, and the largest allowed
+FALL_EVENTS_DEFAULT_LIMIT = 1000
+FALL_EVENTS_MAX_LIMIT = 10000
+
+# Rows fetched per round trip by the server-side cursor
+FALL_EVENTS_FETCH_SIZE = 500
+
+# Postgres channel announcing new fall events (see schema.sql), events
+# buffered per streaming client, and how many a client may miss before it is
+# disconnected so it can catch up with Last-Event-ID
+FALL_EVENTS_CHANNEL = "fall_events"
+STREAM_CLIENT_QUEUE_SIZE = 100
+STREAM_CLIENT_MAX_DROPPED = 100
+STREAM_KEEPALIVE = 15
+
+# Roll back whatever is left open and hand the connection back to the pool,
+# discarding it if it broke
+def release_connection(conn):
+    try:
+        if not conn.closed:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    db_pool.putconn(conn, close=bool(conn.closed))
+
+@contextmanager
+def db_connection():
+    conn = db_pool.getconn()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+# Keyset cursor for /fall_events: the (event_time, id) of the last event a
+# client has seen, as an opaque URL-safe string
+def encode_cursor(event_time, event_id):
+    return base64.urlsafe_b64encode(f"{event_time.isoformat()}|{event_id}".encode()).decode()
+
+def decode_cursor(cursor):
+    event_time, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(event_time), int(event_id)
+
+# A fall event ready for JSON with its timestamps in ISO 8601. Rows read
+# through psycopg2 hold datetimes and NOTIFY payloads (row_to_json) hold
+# ISO strings with their own precision, so both are parsed and written the
+# same way and /fall_events and the stream agree.
+EVENT_TIMESTAMPS = ('event_time', 'window_time', 'end_time')
+
+def event_to_json(event, cursor):
+    event = dict(event, cursor=cursor)
+    for field in EVENT_TIMESTAMPS:
+        value = event.get(field)
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if value is not None:
+            event[field] = value.isoformat()
+    return event
+
+# Fans fall events out to every connected stream client from a single
+# LISTEN connection. Each client gets a bounded queue; when a client falls
+# behind the oldest events are dropped for it, and once it has lost too many
+# it is told to reconnect instead of slowing anyone else down.
+class FallEventBroadcaster:
+    def __init__(self, channel=FALL_EVENTS_CHANNEL):
+        self.channel = channel
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self):
+        subscriber = StreamSubscriber()
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="fall-event-listener", daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+                                        host=DB_HOST, port=DB_PORT)
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {self.channel}")
+                logging.info(f"Listening for fall events on channel {self.channel}")
+                backoff = 1
+                while True:
+                    if select.select([conn], [], [], STREAM_KEEPALIVE) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.publish(json.loads(notify.payload))
+                        except ValueError as e:
+                            logging.error(f"Invalid fall event notification: {e}")
+            except psycopg2.Error as e:
+                logging.error(f"Fall event listener failed, reconnecting in {backoff}s: {e}")
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, 30)
+
+class StreamSubscriber:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=STREAM_CLIENT_QUEUE_SIZE)
+        self.dropped = 0
+
+    def put(self, event):
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    @property
+    def lagging(self):
+        return self.dropped > STREAM_CLIENT_MAX_DROPPED
+
+broadcaster = FallEventBroadcaster()
 
 @app.route('/register', methods=['POST'])
 def register():
@@ -36,15 +188,14 @@ def register():
     hashed_password = generate_password_hash(password)
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with db_connection() as conn:
+            cursor = conn.cursor()
 
-        insert_query = sql.SQL("INSERT INTO users (username, password, email) VALUES (%s, %s, %s)")
-        cursor.execute(insert_query, (username, hashed_password, email))
-        conn.commit()
+            insert_query = sql.SQL("INSERT INTO users (username, password, email) VALUES (%s, %s, %s)")
+            cursor.execute(insert_query, (username, hashed_password, email))
+            conn.commit()
 
-        cursor.close()
-        conn.close()
+            cursor.close()
 
         return jsonify({"message": "User registered successfully"}), 201
     except psycopg2.Error as e:
@@ -61,14 +212,13 @@ def login():
         return jsonify({"message": "Username and password are required"}), 400
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        with db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-        cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
-        user = cursor.fetchone()
+            cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
+            user = cursor.fetchone()
 
-        cursor.close()
-        conn.close()
+            cursor.close()
 
         if user and check_password_hash(user['password'], password):
             return jsonify({"message": "Login successful"}), 200
@@ -80,33 +230,149 @@ def login():
     except psycopg2.Error as e:
         return jsonify({"message": f"Failed to authenticate user: {e}"}), 500
 
+# Fall events ordered by (event_time, id), paginated by keyset instead of
+# OFFSET and streamed from a server-side cursor.
+#
+# Query parameters:
+#   since   ISO timestamp, oldest event to return (default: 30 days ago)
+#   cursor  the "cursor" field of the last event of the previous page
+#   limit   page size (default 1000, at most 10000)
+#   device  only events of this device ID
+#   label   only events with this label
 @app.route('/fall_events', methods=['GET'])
 def get_fall_events():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        since = request.args.get('since')
+        since = datetime.fromisoformat(since) if since else datetime.now() - timedelta(days=30)
+        limit = min(int(request.args.get('limit', FALL_EVENTS_DEFAULT_LIMIT)), FALL_EVENTS_MAX_LIMIT)
+        cursor_key = request.args.get('cursor')
+        cursor_key = decode_cursor(cursor_key) if cursor_key else None
+    except ValueError as e:
+        return jsonify({"message": f"Invalid query parameter: {e}"}), 400
+    if limit <= 0:
+        return jsonify({"message": "Invalid query parameter: limit must be positive"}), 400
 
-        # Calculate the date one month ago from today
-        one_month_ago = datetime.now() - timedelta(days=30)
+    conditions = ["event_time >= %s"]
+    params = [since]
+    if cursor_key:
+        conditions.append("(event_time, id) > (%s, %s)")
+        params.extend(cursor_key)
+    if request.args.get('device'):
+        conditions.append("device_id = %s")
+        params.append(request.args['device'])
+    if request.args.get('label'):
+        conditions.append("label = %s")
+        params.append(request.args['label'])
+    params.append(limit)
 
-        # Query to get fall events from the last month
-        cursor.execute("""
-            SELECT * FROM fall_events 
-            WHERE event_time >= %s
-            ORDER BY event_time
-        """, (one_month_ago,))
+    query = f"""
+        SELECT * FROM fall_events
+        WHERE {' AND '.join(conditions)}
+        ORDER BY event_time, id
+        LIMIT %s
+    """
 
-        fall_events = cursor.fetchall()
+    conn = None
+    try:
+        conn = db_pool.getconn()
+        cursor = conn.cursor('fall_events_stream', cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.itersize = FALL_EVENTS_FETCH_SIZE
+        cursor.execute(query, params)
+        rows = iter(cursor)  # Iterating fetches itersize rows per round trip
+        first = next(rows, None)  # Surface query errors before the response starts
+    except psycopg2.Error as e:
+        if conn is not None:
+            release_connection(conn)
+        return jsonify({"message": f"Failed to fetch fall events: {e}"}), 500
 
-        cursor.close()
-        conn.close()
+    # Once only: when the body is read to the end and when the response is
+    # closed, which also happens if the client leaves before the first chunk
+    def release():
+        nonlocal conn
+        if conn is not None:
+            release_connection(conn)
+            conn = None
 
-        # Convert the result to a list of dictionaries
-        fall_events_list = [dict(event) for event in fall_events]
+    def generate():
+        try:
+            yield '['
+            separator = ''
+            events = itertools.chain([first], rows) if first is not None else []
+            for event in events:
+                event = event_to_json(event, encode_cursor(event['event_time'], event['id']))
+                yield separator + app.json.dumps(event)
+                separator = ','
+            yield ']'
+        finally:
+            release()
 
-        return jsonify(fall_events_list), 200
-    except psycopg2.Error as e:
-        return jsonify({"message": f"Failed to fetch fall events: {e}"}), 500
+    response = Response(stream_with_context(generate()), 200, mimetype='application/json')
+    response.call_on_close(release)
+    return response
+
+def format_stream_event(event):
+    event_time = event['event_time']
+    if isinstance(event_time, str):
+        event_time = datetime.fromisoformat(event_time)
+    cursor = encode_cursor(event_time, event['id'])
+    event = event_to_json(event, cursor)  # A copy: live events are shared by all clients
+    return f"id: {cursor}\nevent: fall_event\ndata: {app.json.dumps(event)}\n\n"
+
+# Server-sent events stream of new fall events. A client reconnecting with
+# a Last-Event-ID header first gets the events it missed, read once from the
+# database, and then the live stream; nobody polls the table.
+@app.route('/fall_events/stream', methods=['GET'])
+def stream_fall_events():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    try:
+        last_key = decode_cursor(last_event_id) if last_event_id else None
+    except ValueError as e:
+        return jsonify({"message": f"Invalid Last-Event-ID: {e}"}), 400
+
+    # Subscribe before replaying so nothing inserted in between is lost
+    subscriber = broadcaster.subscribe()
+    missed = []
+    if last_key:
+        try:
+            with db_connection() as conn:
+                cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+                cursor.execute("""
+                    SELECT * FROM fall_events
+                    WHERE (event_time, id) > (%s, %s)
+                    ORDER BY event_time, id
+                    LIMIT %s
+                """, (*last_key, FALL_EVENTS_MAX_LIMIT))
+                missed = cursor.fetchall()
+                cursor.close()
+        except psycopg2.Error as e:
+            broadcaster.unsubscribe(subscriber)
+            return jsonify({"message": f"Failed to fetch missed fall events: {e}"}), 500
+        if missed:
+            last_key = (missed[-1]['event_time'], missed[-1]['id'])
+
+    def generate():
+        try:
+            for event in missed:
+                yield format_stream_event(event)
+            while not subscriber.lagging:
+                try:
+                    event = subscriber.queue.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if last_key and (datetime.fromisoformat(event['event_time']), event['id']) <= last_key:
+                    continue  # Already sent as part of the replay
+                yield format_stream_event(event)
+            # Too far behind: ask the client to reconnect and catch up from its Last-Event-ID
+            yield "event: reconnect\ndata: {}\n\n"
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(stream_with_context(generate()), 200, headers, mimetype='text/event-stream')
+    # The generator never starts if the client leaves before the first chunk
+    response.call_on_close(lambda: broadcaster.unsubscribe(subscriber))
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0')
@@ -0,0 +1,77 @@
+import argparse
+import io
+import random
+import time
+from datetime import datetime, timedelta
+import psycopg2
+from app import app, DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+
+# Seeds a local fall_events table with synthetic rows and times paging
+# through /fall_events, to check that response time and memory stay flat as
+# the table grows. Run against a throwaway database: python seed_fall_events.py
+
+LABELS = [
+    "(20) Jatuh Depan Coba Duduk",
+    "(21) Jatuh belakang coba duduk",
+    "(22) Jatuh samping pas coba duduk",
+]
+
+def seed(conn, rows, devices, days, chunk=100000):
+    cur = conn.cursor()
+    start = datetime.now() - timedelta(days=days)
+    step = timedelta(days=days) / rows
+    started = time.perf_counter()
+    for offset in range(0, rows, chunk):
+        buffer = io.StringIO()
+        for i in range(offset, min(offset + chunk, rows)):
+            event_time = start + step * i
+            buffer.write(f"{random.choice(LABELS)}\t{event_time.isoformat()}\t{random.randrange(devices)}\t"
+                         f"{random.uniform(0.5, 1.0):.4f}\t{event_time.isoformat()}\n")
+        buffer.seek(0)
+        cur.copy_from(buffer, 'fall_events', columns=('label', 'event_time', 'device_id', 'confidence', 'window_time'))
+        conn.commit()
+    cur.execute("ANALYZE fall_events")
+    conn.commit()
+    cur.close()
+    print(f"Seeded {rows} rows in {time.perf_counter() - started:.1f}s")
+
+# Walk /fall_events page by page through the test client and report timings
+def walk_pages(limit, max_pages, query=""):
+    client = app.test_client()
+    cursor = None
+    timings = []
+    total = 0
+    while len(timings) < max_pages:
+        url = f"/fall_events?limit={limit}{query}" + (f"&cursor={cursor}" if cursor else "")
+        started = time.perf_counter()
+        response = client.get(url)
+        events = response.get_json()
+        timings.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            print(f"Request failed: {response.status_code} {events}")
+            break
+        total += len(events)
+        if len(events) < limit:
+            break
+        cursor = events[-1]['cursor']
+    timings.sort()
+    print(f"{len(timings)} pages, {total} events{' (' + query + ')' if query else ''}: "
+          f"p50 {timings[len(timings) // 2] * 1000:.1f} ms, max {timings[-1] * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed fall_events and load-test /fall_events")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--skip-seed", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT)
+        seed(conn, args.rows, args.devices, args.days)
+        conn.close()
+
+    walk_pages(args.limit, args.pages)
+    walk_pages(args.limit, args.pages, "&device=1")
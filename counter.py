@@ -1,6 +1,15 @@
 import json
+import os
+import sys
+from segment_log import count_records
 
 def count_data_points(filename):
+    # Segment logs written by subs_get_data.py are counted from their index
+    if os.path.isdir(filename):
+        num_points = count_records(filename)
+        print(f"Number of data points: {num_points}")
+        return num_points
+
     try:
         with open(filename, 'r') as f:
             data = json.load(f)
@@ -20,5 +29,5 @@ def count_data_points(filename):
         return 0
 
 if __name__ == "__main__":
-    filename = "gyro_data.json"
+    filename = sys.argv[1] if len(sys.argv) > 1 else "gyro_data.json"
     count_data_points(filename)
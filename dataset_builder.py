@@ -0,0 +1,184 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from recording import read_recording, RECORDING_SUFFIX, COLUMNS, SAMPLE_DTYPE
+
+# Training windows from the captures in datasets/.
+#
+# Every recording (.gyro, or an old .json capture) is parsed once in a
+# process pool and cached as <sha256>.npy in DATASET_CACHE_DIR, keyed by
+# the hash of the source file, so a rebuild only parses new or changed
+# files. The cached recordings are then joined into one channel-major
+# (3, total) float32 array, itself cached as a .npy file keyed by the set
+# of source hashes and opened as a memmap.
+#
+# Windows are a strided view of that array in the (N, 3, window, 1) layout
+# the model takes, one per `hop` samples, without copying anything. Each
+# recording is trimmed to a multiple of `hop` so windows start on the same
+# grid in every recording; windows that would cross into the next
+# recording are labelled -1 and left out of `index`. batches() copies the
+# selected windows one batch at a time.
+#
+# Usage: python dataset_builder.py [--data datasets] [--window 120] [--hop 10]
+DATASET_CACHE_DIR = ".dataset_cache"
+SOURCE_INDEX = "sources.json"
+
+Dataset = namedtuple('Dataset', ['windows', 'labels', 'index', 'samples'])
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_source(path):
+    if path.endswith(RECORDING_SUFFIX):
+        metadata, samples = read_recording(path)
+        return int(metadata['label']), np.asarray(samples, dtype=SAMPLE_DTYPE)
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if not data:
+        raise ValueError(f"Empty capture: {path}")
+    samples = np.array([[point[column] for column in COLUMNS] for point in data], dtype=SAMPLE_DTYPE)
+    return int(data[0]['label']), samples
+
+# Runs in a pool worker: parse one source and write it to the cache.
+# Returns (path, entry) for the source index.
+def cache_source(path, cache_dir):
+    stat = os.stat(path)
+    sha256 = file_hash(path)
+    label, samples = read_source(path)
+    np.save(os.path.join(cache_dir, f"{sha256}.npy"), samples)
+    return path, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256,
+                  'label': label, 'count': len(samples)}
+
+def read_source_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, SOURCE_INDEX), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_source_index(cache_dir, index):
+    path = os.path.join(cache_dir, SOURCE_INDEX)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def find_sources(directory):
+    paths = glob.glob(os.path.join(directory, f"*{RECORDING_SUFFIX}"))
+    # An old JSON capture converted by recording.py is only read once
+    converted = {os.path.splitext(path)[0] for path in paths}
+    paths += [path for path in glob.glob(os.path.join(directory, "*.json"))
+              if os.path.splitext(path)[0] not in converted]
+    return sorted(paths)
+
+# Bring the per-recording cache up to date with `directory`, parsing new
+# and changed sources on `workers` processes. Returns the index entries of
+# the current sources, in path order.
+def update_cache(directory, cache_dir=DATASET_CACHE_DIR, workers=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    index = read_source_index(cache_dir)
+    current, stale = {}, []
+    for path in find_sources(directory):
+        entry = index.get(path)
+        stat = os.stat(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns \
+                and os.path.exists(os.path.join(cache_dir, f"{entry['sha256']}.npy")):
+            current[path] = entry
+        else:
+            stale.append(path)
+
+    if stale:
+        logging.info(f"Parsing {len(stale)} new or changed recordings")
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(cache_source, path, cache_dir) for path in stale]
+            for path, future in zip(stale, futures):
+                try:
+                    current[path] = future.result()[1]
+                except (OSError, ValueError, KeyError) as e:
+                    logging.error(f"Skipping recording {path}: {e}")
+                    print(f"Skipping {path}: {e}")
+    if stale or len(current) != len(index):
+        write_source_index(cache_dir, current)
+    return [current[path] for path in sorted(current)]
+
+# Join the cached recordings, each trimmed to a multiple of `hop`, into
+# channel-major samples plus per-sample labels and recording ids
+def assemble(entries, hop, cache_dir=DATASET_CACHE_DIR):
+    key = hashlib.sha256(json.dumps([[e['sha256'] for e in entries], hop]).encode()).hexdigest()[:16]
+    samples_path = os.path.join(cache_dir, f"dataset-{key}-samples.npy")
+    meta_path = os.path.join(cache_dir, f"dataset-{key}-meta.npz")
+    if not (os.path.exists(samples_path) and os.path.exists(meta_path)):
+        lengths = [e['count'] - e['count'] % hop for e in entries]
+        total = sum(lengths)
+        samples = np.lib.format.open_memmap(samples_path + ".tmp", mode='w+', dtype=SAMPLE_DTYPE,
+                                            shape=(len(COLUMNS), total))
+        labels = np.empty(total, dtype=np.int64)
+        recording = np.empty(total, dtype=np.int32)
+        start = 0
+        for i, (entry, length) in enumerate(zip(entries, lengths)):
+            source = np.load(os.path.join(cache_dir, f"{entry['sha256']}.npy"), mmap_mode='r')
+            samples[:, start:start + length] = source[:length].T
+            labels[start:start + length] = entry['label']
+            recording[start:start + length] = i
+            start += length
+        samples.flush()
+        del samples
+        os.replace(samples_path + ".tmp", samples_path)
+        np.savez_compressed(meta_path, labels=labels, recording=recording)
+    meta = np.load(meta_path)
+    return np.load(samples_path, mmap_mode='r'), meta['labels'], meta['recording']
+
+# (N, 3, window, 1) view of channel-major samples, one window every `hop`
+# samples; no data is copied
+def sliding_windows(samples, window, hop):
+    channels, total = samples.shape
+    count = max(0, (total - window) // hop + 1)
+    channel_stride, sample_stride = samples.strides
+    return as_strided(samples, shape=(count, channels, window, 1),
+                      strides=(hop * sample_stride, channel_stride, sample_stride, sample_stride),
+                      writeable=False)
+
+def build_dataset(directory="datasets", window=120, hop=10, cache_dir=DATASET_CACHE_DIR, workers=None):
+    entries = update_cache(directory, cache_dir, workers)
+    samples, sample_labels, recording = assemble(entries, hop, cache_dir)
+    windows = sliding_windows(samples, window, hop)
+    starts = np.arange(len(windows)) * hop
+    # A window is usable when its first and last sample come from the same recording
+    same = recording[starts] == recording[starts + window - 1] if len(windows) else np.empty(0, dtype=bool)
+    labels = np.where(same, sample_labels[starts], -1)
+    return Dataset(windows, labels, np.flatnonzero(labels >= 0), samples)
+
+# Yield (windows, labels) batches of usable windows, copying one batch at a time
+def batches(dataset, batch_size=256, shuffle=True, seed=None):
+    index = dataset.index
+    if shuffle:
+        index = np.random.default_rng(seed).permutation(index)
+    for start in range(0, len(index), batch_size):
+        selected = index[start:start + batch_size]
+        yield np.ascontiguousarray(dataset.windows[selected]), dataset.labels[selected]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build training windows from recorded datasets")
+    parser.add_argument("--data", default="datasets")
+    parser.add_argument("--window", type=int, default=120)
+    parser.add_argument("--hop", type=int, default=10)
+    parser.add_argument("--cache-dir", default=DATASET_CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    dataset = build_dataset(args.data, args.window, args.hop, args.cache_dir, args.workers)
+    labels, counts = np.unique(dataset.labels[dataset.index], return_counts=True)
+    print(f"{len(dataset.index)} windows of shape {dataset.windows.shape[1:]} "
+          f"({len(dataset.windows) - len(dataset.index)} crossing recordings left out)")
+    for label, count in zip(labels, counts):
+        print(f"  label {label}: {count} windows")
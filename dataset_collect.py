@@ -1,24 +1,23 @@
-import struct
 import logging
 import os
 import time
 from datetime import datetime
-import paho.mqtt.client as mqtt
-import json
+from gyro_protocol import decode_payload
+from recording import RecordingWriter, RECORDING_SUFFIX
+from ingest import IngestCore
+from metrics import install_rate_limited_logging
 
 # Setup logging
 logging.basicConfig(filename='mqtt_client.log', level=logging.DEBUG, 
                     format='%(asctime)s %(levelname)s %(message)s')
+install_rate_limited_logging()
 
 # Path to save the datasets
 DATASET_DIR = "datasets"
 os.makedirs(DATASET_DIR, exist_ok=True)
 
 # Global variables to hold collected data and counters
-gyro_x = []
-gyro_y = []
-gyro_z = []
-ids = []  # List to hold IDs
+recordings = {}  # Open RecordingWriter per device for the current capture
 current_label = None
 dataset_index = {}  # Dictionary to store dataset index for each label
 start_time = None  # Variable to hold start time for collection
@@ -32,54 +31,30 @@ label_mapping = {
     4: "(22) Jatuh samping pas coba duduk"
 }
 
-# Function to save data to a file
-def save_to_file(gyro_x, gyro_y, gyro_z, ids, label):
-    global dataset_index
-    try:
-        if label not in dataset_index:
-            dataset_index[label] = 0
-        else:
-            dataset_index[label] += 1
-        
-        filename = os.path.join(DATASET_DIR, f"dataset_label_{label}_{dataset_index[label]}_{int(time.time())}.json")
-        
-        data = []
-        for i in range(len(gyro_x)):
-            data_point = {
-                'ID': ids[i],  # Use the ID from the MQTT message
-                'gyX': gyro_x[i],
-                'gyY': gyro_y[i],
-                'gyZ': gyro_z[i],
-                'label': label
-            }
-            data.append(data_point)
-        
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=4)
-        
-        num_records = len(data)
-        print(f"Data saved to {filename} with {num_records} records")
-        logging.info(f"Data saved to {filename} with {num_records} records")
-        
-        # Clear the 'data' variable after saving to file
-        data.clear()
-
-        # Reset data counters after saving
-        gyro_x.clear()
-        gyro_y.clear()
-        gyro_z.clear()
-        ids.clear()
-
-    except Exception as e:
-        logging.error(f"Failed to save data to file: {e}")
-
-# MQTT callback functions
-def on_connect(client, userdata, flags, rc):
-    logging.info(f"Connected with result code {rc}")
-    client.subscribe("fall-detection/sensor/gyro")
-
-def on_message(client, userdata, msg):
-    global gyro_x, gyro_y, gyro_z, ids, current_label, start_time
+# Function to open a streaming recording for one device
+def open_recording(device_id, label):
+    if label not in dataset_index:
+        dataset_index[label] = 0
+    else:
+        dataset_index[label] += 1
+    
+    filename = os.path.join(DATASET_DIR, f"dataset_label_{label}_{dataset_index[label]}_{int(time.time())}{RECORDING_SUFFIX}")
+    return RecordingWriter(filename, label, device_id, start_time=start_time)
+
+# Function to close every recording of the current capture
+def close_recordings():
+    for writer in recordings.values():
+        try:
+            writer.close()
+            print(f"Data saved to {writer.path} with {writer.count} records")
+            logging.info(f"Data saved to {writer.path} with {writer.count} records")
+        except Exception as e:
+            logging.error(f"Failed to save data to file: {e}")
+    recordings.clear()
+
+# Sink for every message received by the ingest core
+def on_message(msg):
+    global current_label, start_time
     
     if current_label is None:
         logging.warning("Received message but no label is selected yet. Ignoring.")
@@ -87,28 +62,25 @@ def on_message(client, userdata, msg):
     
     logging.info(f"Message received on topic {msg.topic}")
     try:
-        # Unpack the binary data
-        payload = msg.payload
-        if len(payload) == 13:
-            device_id = chr(payload[0])
-            gyX, gyY, gyZ = struct.unpack('fff', payload[1:])
-            
-            gyro_x.append(gyX)
-            gyro_y.append(gyY)
-            gyro_z.append(gyZ)
-            ids.append(device_id)  # Collect the ID from the MQTT message
+        # Decode the binary data (legacy 13-byte sample or framed batch)
+        device_id, seq, sample_rate, samples = decode_payload(msg.payload)
+        
+        # Stream every device into its own recording so captures never interleave belts
+        if device_id not in recordings:
+            recordings[device_id] = open_recording(device_id, current_label)
+        recordings[device_id].append(samples)
+        
+        # Check if time limit (12 seconds) is reached
+        if time.time() - start_time >= 12:
+            logging.info(f"Time limit reached for label {current_label}")
+            # Finish the recordings, one file per device
+            close_recordings()
             
-            # Check if time limit (12 seconds) is reached
-            if time.time() - start_time >= 12:
-                logging.info(f"Time limit reached for label {current_label}")
-                # Save collected data
-                save_to_file(gyro_x, gyro_y, gyro_z, ids, current_label)
-                
-                # Reset current_label to indicate data collection has stopped
-                current_label = None
+            # Reset current_label to indicate data collection has stopped
+            current_label = None
 
-    except struct.error as e:
-        logging.error(f"Failed to unpack binary data: {e}")
+    except ValueError as e:
+        logging.error(f"Failed to decode binary data: {e}")
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
 
@@ -147,16 +119,12 @@ def main():
             time.sleep(0.1)  # Sleep to reduce CPU usage and allow for message handling
 
 if __name__ == "__main__":
-    # Setup MQTT client
-    client = mqtt.Client()
-    client.on_connect = on_connect
-    client.on_message = on_message
-
-    # Connect to the MQTT broker
-    client.connect("34.143.200.120", 1883, 60)
-    client.loop_start()
+    # Receive messages through the shared ingest core on a background thread
+    core = IngestCore()
+    core.add_sink("dataset-collector", on_message)
+    core.start()
 
     main()
 
-    client.loop_stop()
-    client.disconnect()
+    core.stop()
+    close_recordings()
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+import numpy as np
+from ring_buffer import RingBuffer
+from stream_timing import StreamClock, interpolate_gap
+from activity_gate import ActivityFeatures
+
+# State kept for one belt: its sample window, arrival timing and when it
+# was last handed to the model. With `activity_window` set it also keeps
+# the running activity features of the latest window of that size.
+#
+# Short gaps are filled by interpolation so the buffer stays on a uniform
+# time base; after a longer one, windows reaching back across it are not
+# valid (see window_valid()) until enough new samples arrived.
+class DeviceState:
+    def __init__(self, device_id, capacity, activity_window=None, max_fill=10, gap_timeout=0.25):
+        self.device_id = device_id
+        self.buffer = RingBuffer(capacity)
+        self.activity = ActivityFeatures(activity_window, capacity) if activity_window else None
+        self.clock = StreamClock(device_id, max_fill, gap_timeout)
+        self.last_seen = time.monotonic()
+        self.valid_from = 0  # buffer.count at the last break in the stream
+        self.predicted_count = 0  # buffer.count at the last prediction
+
+    @property
+    def missed(self):
+        # Samples lost according to the sequence numbers (estimated for legacy devices)
+        return self.clock.missed
+
+    def add_samples(self, samples, seq=None, received=None, sample_rate=None):
+        # samples is an (n, 3) array; seq is the sequence number of the first
+        # one when the device sends framed messages, received its arrival time
+        fill, broken = self.clock.observe(len(samples), time.time() if received is None else received,
+                                          seq, sample_rate)
+        if broken:
+            self.valid_from = self.buffer.count
+        elif fill and self.buffer.count:
+            samples = np.concatenate([interpolate_gap(self.buffer.window(1)[:, 0], samples[0], fill), samples])
+        if len(samples) == 1:
+            self.buffer.append(samples[0])
+        else:
+            self.buffer.append_many(samples)
+        if self.activity is not None:
+            self.activity.add_samples(samples)
+        self.last_seen = time.monotonic()
+
+    def window_valid(self, window_size):
+        # The latest window holds no break in the stream
+        return self.buffer.count - window_size >= self.valid_from
+
+    def prediction_due(self, window_size, hop=1):
+        # Due once the window is full and `hop` new samples arrived since
+        # the last prediction, so unchanged windows are never re-run
+        count = self.buffer.count
+        return count >= window_size and count - self.predicted_count >= hop
+
+    def mark_predicted(self, count):
+        self.predicted_count = count
+
+# Registry of all devices seen on the broker subscription, keyed by device ID.
+# Memory is bounded: each device owns a fixed-size ring buffer and at most
+# `max_devices` are tracked, evicting ones idle longer than `idle_timeout`.
+class DeviceRegistry:
+    def __init__(self, capacity=1200, max_devices=512, idle_timeout=300, activity_window=None,
+                 max_fill=10, gap_timeout=0.25):
+        self.capacity = capacity
+        self.activity_window = activity_window
+        self.max_fill = max_fill
+        self.gap_timeout = gap_timeout
+        self.max_devices = max_devices
+        self.idle_timeout = idle_timeout
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def get(self, device_id):
+        device = self._devices.get(device_id)
+        if device is not None:
+            return device
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is None:
+                if len(self._devices) >= self.max_devices:
+                    self._evict_idle()
+                if len(self._devices) >= self.max_devices:
+                    logging.error(f"Device registry full, ignoring device {device_id}")
+                    return None
+                device = DeviceState(device_id, self.capacity, self.activity_window, self.max_fill, self.gap_timeout)
+                self._devices[device_id] = device
+                logging.info(f"Registered device {device_id}")
+            return device
+
+    def add_samples(self, device_id, samples, seq=None, received=None, sample_rate=None):
+        device = self.get(device_id)
+        if device is not None:
+            device.add_samples(samples, seq, received, sample_rate)
+        return device
+
+    def devices(self):
+        return list(self._devices.values())
+
+    def evict_idle(self):
+        with self._lock:
+            return self._evict_idle()
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [device_id for device_id, device in self._devices.items() if device.last_seen < cutoff]
+        for device_id in idle:
+            del self._devices[device_id]
+            logging.info(f"Evicted idle device {device_id}")
+        return idle
+
+    def __len__(self):
+        return len(self._devices)
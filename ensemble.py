@@ -0,0 +1,120 @@
+import logging
+import time
+import numpy as np
+from metrics import Counter, Histogram
+from model_runtime import ReloadingRuntime
+from resample import resample_windows
+
+MEMBER_SECONDS = Histogram("ensemble_member_batch_seconds", "Run time per batch of each ensemble model")
+RESAMPLE_SECONDS = Histogram("ensemble_resample_seconds", "Time to build one resampled input view of a batch")
+MEMBER_DISSENT = Counter("ensemble_member_dissent_total", "Windows where an ensemble model disagreed with the combined class")
+
+# Several models behind one callable, for BatchInferenceEngine and
+# WorkerPoolEngine.
+#
+# The shipped models look at the same window of samples at different
+# lengths: new_model.h5 takes the 120 samples as they are (3, 120, 1),
+# model.h5 takes them upsampled to (3, 600, 1) and
+# allnewfall-detect-model.h5 resampled to (3, 25, 1). The engine still
+# batches plain (N, 3, window, 1) windows from the one per-device buffer;
+# each distinct length is resampled from that batch once, in one
+# vectorised pass, and shared by every model that takes it. All models run
+# on the same batch and their class probabilities are combined by `rule`:
+#   weighted  weighted mean of the probabilities
+#   vote      the class with the largest weighted share of the models
+#             voting for it (their argmax), ties broken by the weighted
+#             mean probability; the row is the weighted mean of the
+#             probabilities of the models that voted for it, whose argmax
+#             is that class
+# Either way the result is an (N, classes) array of probabilities, so
+# predictions, and the confidence stored with a fall, are handled exactly
+# as for a single model.
+RULES = ('weighted', 'vote')
+
+class EnsembleMember:
+    def __init__(self, name, model, weight=1.0, length=None):
+        self.name = name
+        self.model = model
+        self.weight = weight
+        self._length = length
+
+    # Samples per channel the model takes; read from its input shape
+    # (None, 3, length, 1) unless given, which a reload may change
+    @property
+    def length(self):
+        return self._length or int(self.model.input_shape[2])
+
+class EnsembleModel:
+    def __init__(self, members, rule='weighted'):
+        if rule not in RULES:
+            raise ValueError(f"Unknown ensemble rule {rule!r}, expected one of {RULES}")
+        if not members:
+            raise ValueError("An ensemble needs at least one model")
+        self.members = members
+        self.rule = rule
+        weights = np.array([member.weight for member in members], dtype=np.float64)
+        self._weights = weights / weights.sum()
+        logging.info(f"Ensemble ({rule}) of " + ", ".join(
+            f"{member.name} x{member.weight:g} at {member.length} samples" for member in members))
+
+    def __call__(self, batch):
+        views = {batch.shape[2]: batch}
+        outputs = []
+        for member in self.members:
+            inputs = views.get(member.length)
+            if inputs is None:
+                inputs = views[member.length] = resample_view(batch, member.length)
+            started = time.perf_counter()
+            outputs.append(np.asarray(member.model(inputs), dtype=np.float64))
+            MEMBER_SECONDS.observe(time.perf_counter() - started, model=member.name)
+        return self.combine(outputs)
+
+    # Combine the (N, classes) outputs of the members, in member order
+    def combine(self, outputs):
+        probabilities = np.stack(outputs)  # (members, N, classes)
+        mean = np.einsum('m,mnc->nc', self._weights, probabilities)
+        if self.rule == 'weighted':
+            combined = mean
+            winners = combined.argmax(axis=1)
+        else:
+            votes = probabilities.argmax(axis=2)  # (members, N)
+            shares = np.zeros_like(mean)
+            for weight, vote in zip(self._weights, votes):
+                shares[np.arange(len(vote)), vote] += weight
+            tied = np.isclose(shares, shares.max(axis=1, keepdims=True))
+            winners = np.where(tied, mean, -np.inf).argmax(axis=1)
+            voters = self._weights[:, None] * (votes == winners)  # (members, N)
+            combined = np.einsum('mn,mnc->nc', voters / voters.sum(axis=0), probabilities)
+        for member, output in zip(self.members, outputs):
+            dissent = int(np.count_nonzero(output.argmax(axis=1) != winners))
+            if dissent:
+                MEMBER_DISSENT.inc(dissent, model=member.name)
+        return combined.astype(np.float32)
+
+    def close(self):
+        for member in self.members:
+            if hasattr(member.model, 'close'):
+                member.model.close()
+
+# (N, 3, window, 1) batch resampled along time to (N, 3, length, 1), like
+# resample.upsample_data does for one window
+def resample_view(batch, length):
+    started = time.perf_counter()
+    view = resample_windows(batch, length)
+    RESAMPLE_SECONDS.observe(time.perf_counter() - started, length=length)
+    return view
+
+# Build an ensemble from `spec`, {'models': [(path, weight), ...], 'rule': ...};
+# every model follows its file like ReloadingRuntime. Module-level and
+# driven by plain data so it can be handed to WorkerPoolEngine workers as
+# their loader, with the spec in place of the model path.
+def load_ensemble(spec, backend=None):
+    members = []
+    try:
+        for path, weight in spec['models']:
+            members.append(EnsembleMember(path, ReloadingRuntime(path, backend), weight))
+        return EnsembleModel(members, spec.get('rule', 'weighted'))
+    except Exception:
+        for member in members:
+            member.model.close()  # Stop the watchers of the models already loaded
+        raise
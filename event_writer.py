@@ -0,0 +1,177 @@
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+from metrics import Counter, Histogram
+
+DB_WRITE_SECONDS = Histogram("fall_event_write_seconds", "Time to write one group of fall events")
+EVENTS_WRITTEN = Counter("fall_events_written_total", "Fall events written to the database")
+EVENTS_DROPPED = Counter("fall_events_dropped_total", "Fall event writes dropped because the queue was full or on shutdown")
+
+# Columns written for every fall event, in insert order
+EVENT_COLUMNS = ('device_id', 'label', 'confidence', 'window_time', 'end_time', 'windows')
+
+# Columns set when an event completes; the row is found by device_id and
+# window_time, which identify an event
+COMPLETE_COLUMNS = ('label', 'confidence', 'end_time', 'windows')
+
+# Writes fall events to the fall_events table from a background thread.
+#
+# Events are queued by the inference path without touching the database and
+# written in groups as one multi-row INSERT. While the database is down the
+# writer keeps retrying the same group with exponential backoff; the queue is
+# bounded, so once it is full new events are dropped and logged instead of
+# blocking inference.
+#
+# An event is inserted as soon as it opens, so the row (and the NOTIFY that
+# feeds the API stream) goes out right away, and complete() later updates
+# it with how the event ended. Within a group, inserts are written before
+# updates, in one transaction.
+#
+# `pool` is anything with getconn()/putconn(conn, close=False), such as
+# psycopg2.pool.ThreadedConnectionPool or SQLitePool below. `placeholder` is
+# the DB-API parameter marker of the driver ('%s' for psycopg2, '?' for
+# sqlite3).
+class FallEventWriter:
+    def __init__(self, pool, max_queue=1000, batch_size=100, flush_interval=0.5,
+                 min_backoff=0.5, max_backoff=30, placeholder='%s'):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.placeholder = placeholder
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="fall-event-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        # Stop after flushing what is queued, giving up on it after `timeout`
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # window_time and end_time are the first and last window of the event,
+    # `windows` the number of positive windows merged into it
+    def submit(self, device_id, label, confidence, window_time, end_time=None, windows=1):
+        return self._put('insert', (device_id, label, confidence, window_time,
+                                    window_time if end_time is None else end_time, windows))
+
+    # Update the event of `device_id` that started at `window_time` once it
+    # ended; label and confidence are those of its most confident window
+    def complete(self, device_id, window_time, label, confidence, end_time, windows):
+        return self._put('update', (label, confidence, end_time, windows, device_id, window_time))
+
+    def _put(self, kind, values):
+        try:
+            self._queue.put_nowait((kind, values))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            EVENTS_DROPPED.inc()
+            logging.error(f"Fall event queue full, dropping {kind} of the event for device "
+                          f"{values[0] if kind == 'insert' else values[4]}")
+            return False
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while self._running or not self._queue.empty():
+            batch = self._next_batch()
+            if batch:
+                self._write_with_retry(batch)
+
+    def _write_with_retry(self, batch):
+        backoff = self.min_backoff
+        while True:
+            try:
+                with DB_WRITE_SECONDS.time():
+                    inserted = self.write(batch)
+                self.written += inserted
+                EVENTS_WRITTEN.inc(inserted)
+                logging.info(f"Saved {inserted} new and {len(batch) - inserted} completed falling events")
+                return
+            except Exception as e:
+                if not self._running:
+                    logging.error(f"Dropping {len(batch)} falling events on shutdown: {e}")
+                    EVENTS_DROPPED.inc(len(batch))
+                    return
+                delay = backoff * random.uniform(0.5, 1.0)
+                logging.error(f"Failed to save {len(batch)} falling events, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    # Returns how many events were inserted
+    def write(self, batch):
+        inserts = [values for kind, values in batch if kind == 'insert']
+        updates = [values for kind, values in batch if kind == 'update']
+
+        conn = self.pool.getconn()
+        try:
+            cur = conn.cursor()
+            if inserts:
+                row = "(" + ", ".join([self.placeholder] * len(EVENT_COLUMNS)) + ")"
+                cur.execute(f"INSERT INTO fall_events ({', '.join(EVENT_COLUMNS)}) VALUES "
+                            + ", ".join([row] * len(inserts)),
+                            [value for event in inserts for value in event])
+            if updates:
+                assignments = ", ".join(f"{column} = {self.placeholder}" for column in COMPLETE_COLUMNS)
+                cur.executemany(f"UPDATE fall_events SET {assignments} "
+                                f"WHERE device_id = {self.placeholder} AND window_time = {self.placeholder}",
+                                updates)
+            conn.commit()
+            cur.close()
+        except Exception:
+            # The connection may be broken; do not hand it back for reuse
+            self.pool.putconn(conn, close=True)
+            raise
+        self.pool.putconn(conn)
+        return len(inserts)
+
+# Single-connection stand-in for a psycopg2 pool, for running the writer
+# against a local SQLite file
+class SQLitePool:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def getconn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        return self._conn
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.close()
+            self._conn = None
+
+    def closeall(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
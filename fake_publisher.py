@@ -0,0 +1,115 @@
+import argparse
+import struct
+import threading
+import time
+import numpy as np
+import paho.mqtt.client as mqtt
+from gyro_protocol import decode_payload, encode_payload
+
+# Local load generator for the gyro topic. It publishes synthetic samples
+# for many devices, either as legacy 13-byte messages or as framed batches,
+# and counts what comes back on the same topic so the broker and decode
+# cost of both formats can be compared on one machine.
+
+MQTT_BROKER = "localhost"
+MQTT_PORT = 1883
+MQTT_TOPIC = "fall-detection/sensor/gyro"
+
+def make_payloads(devices, frame_size, legacy):
+    rng = np.random.default_rng(0)
+    payloads = []
+    for d in range(devices):
+        device_id = chr(ord('A') + d % 26) if devices <= 26 else chr(33 + d % 94)
+        samples = rng.normal(0, 50, size=(frame_size, 3)).astype(np.float32)
+        if legacy:
+            payloads.extend(encode_payload(device_id, sample, legacy=True) for sample in samples)
+        else:
+            payloads.append(encode_payload(device_id, samples, seq=d))
+    return payloads
+
+# Decode-only benchmark: the old per-message struct.unpack path against
+# decode_payload on legacy messages and on framed batches
+def bench_decode(samples, frame_size):
+    legacy = make_payloads(1, samples, legacy=True)
+    framed = make_payloads(1, frame_size, legacy=False) * max(1, samples // frame_size)
+
+    start = time.perf_counter()
+    for payload in legacy:
+        chr(payload[0]), struct.unpack('fff', payload[1:])
+    struct_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for payload in legacy:
+        decode_payload(payload)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for payload in framed:
+        decode_payload(payload)
+    framed_time = time.perf_counter() - start
+
+    framed_samples = len(framed) * frame_size
+    print(f"struct.unpack legacy: {len(legacy) / struct_time:,.0f} samples/s")
+    print(f"decode_payload legacy: {len(legacy) / legacy_time:,.0f} samples/s")
+    print(f"decode_payload framed x{frame_size}: {framed_samples / framed_time:,.0f} samples/s")
+
+# Broker round-trip benchmark
+def bench_broker(broker, port, devices, frame_size, legacy, duration):
+    received = {'messages': 0, 'samples': 0}
+    lock = threading.Lock()
+    subscribed = threading.Event()
+
+    def on_message(client, userdata, msg):
+        samples = decode_payload(msg.payload)[3]
+        with lock:
+            received['messages'] += 1
+            received['samples'] += len(samples)
+
+    subscriber = mqtt.Client()
+    subscriber.on_message = on_message
+    subscriber.on_subscribe = lambda client, userdata, mid, granted_qos: subscribed.set()
+    subscriber.connect(broker, port, 60)
+    subscriber.subscribe(MQTT_TOPIC)
+    subscriber.loop_start()
+    subscribed.wait(5)
+
+    publisher = mqtt.Client()
+    publisher.connect(broker, port, 60)
+    publisher.loop_start()
+
+    payloads = make_payloads(devices, frame_size, legacy)
+    samples_per_round = devices * frame_size
+    sent_messages = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for payload in payloads:
+            publisher.publish(MQTT_TOPIC, payload)
+        sent_messages += len(payloads)
+    elapsed = time.perf_counter() - start
+    sent_samples = sent_messages // len(payloads) * samples_per_round
+
+    time.sleep(1)  # Let the subscriber drain
+    publisher.loop_stop()
+    publisher.disconnect()
+    subscriber.loop_stop()
+    subscriber.disconnect()
+
+    mode = "legacy" if legacy else f"framed x{frame_size}"
+    print(f"{mode}: published {sent_messages / elapsed:,.0f} messages/s, {sent_samples / elapsed:,.0f} samples/s")
+    print(f"{mode}: received {received['messages'] / elapsed:,.0f} messages/s, {received['samples'] / elapsed:,.0f} samples/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish synthetic gyro data and measure throughput")
+    parser.add_argument("--broker", default=MQTT_BROKER)
+    parser.add_argument("--port", type=int, default=MQTT_PORT)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--frame-size", type=int, default=20, help="samples per framed message")
+    parser.add_argument("--legacy", action="store_true", help="send one 13-byte message per sample")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--decode-only", action="store_true", help="benchmark decoding without a broker")
+    args = parser.parse_args()
+
+    if args.decode_only:
+        bench_decode(100000, args.frame_size)
+    else:
+        bench_broker(args.broker, args.port, args.devices, args.frame_size, args.legacy, args.duration)
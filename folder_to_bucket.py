@@ -1,28 +1,368 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import math
+import mimetypes
 import os
-from google.cloud import storage
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Parallel, resumable upload of the dataset folder to a GCS bucket.
+#
+# Files are uploaded by a thread pool. Each file that was uploaded is
+# recorded in a local manifest (size, mtime and SHA-256), so a rerun only
+# sends new or changed files: a file whose size and mtime match is skipped
+# without reading it, and one that was only touched is skipped after
+# hashing. The manifest is saved every MANIFEST_SAVE_INTERVAL uploads, so
+# an interrupted run resumes where it stopped.
+#
+# Files of COMPOSITE_THRESHOLD bytes or more are uploaded as parts in
+# parallel and joined with a compose request; anything larger than
+# CHUNK_SIZE goes up as a resumable upload in chunks of that size. With
+# gzip=True each file is compressed on the way and stored with
+# Content-Encoding: gzip.
+#
+# The bucket may be a google.cloud.storage bucket (set STORAGE_EMULATOR_HOST
+# to use an emulator) or a FakeBucket directory for tests and benchmarks.
 
 # Path to your JSON key file
 JSON_KEY_PATH = '/path/to/your/json/key.json'
 
-# Initialize a client using JSON key for authentication
-client = storage.Client.from_service_account_json(JSON_KEY_PATH)
+SOURCE_FOLDER = "/home/ecvxevv/fall-detection/mqtt-subscribe/datasets"  # Local directory path containing files to upload
+BUCKET_NAME = "group3-falldetection"
+
+MANIFEST_FILE = "upload_manifest.json"
+MANIFEST_SAVE_INTERVAL = 100
+
+UPLOAD_WORKERS = 16
+CHUNK_SIZE = 8 * 1024 * 1024  # Multiple of 256 KiB, as GCS requires
+COMPOSITE_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 32 * 1024 * 1024
+MAX_COMPOSE_SOURCES = 32
+
+def gcs_bucket(bucket_name, key_path=JSON_KEY_PATH):
+    from google.cloud import storage
+    if os.environ.get('STORAGE_EMULATOR_HOST'):
+        from google.auth.credentials import AnonymousCredentials
+        client = storage.Client(project="emulator", credentials=AnonymousCredentials())
+    else:
+        # Initialize a client using JSON key for authentication
+        client = storage.Client.from_service_account_json(key_path)
+    return client.bucket(bucket_name)
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def content_type(path):
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+# Uploaded files keyed by blob name, saved as JSON next to the caller
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    # True when `path` is stored as `blob_name` with the same content;
+    # refreshes the recorded mtime of files that were only touched
+    def is_current(self, blob_name, path, stat, compressed):
+        entry = self.entries.get(blob_name)
+        if entry is None or entry['size'] != stat.st_size or entry.get('gzip', False) != compressed:
+            return False
+        if entry['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        if entry['sha256'] != file_hash(path):
+            return False
+        self.record(blob_name, stat, entry['sha256'], compressed)
+        return True
+
+    def record(self, blob_name, stat, sha256, compressed):
+        with self._lock:
+            self.entries[blob_name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                       'sha256': sha256, 'gzip': compressed, 'uploaded': time.time()}
+            self._unsaved += 1
+            if self._unsaved >= MANIFEST_SAVE_INTERVAL:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
+        self._unsaved = 0
+
+# Byte range of a file, read through the file object interface blobs upload
+# from. Positions are relative to the start of the range; resumable uploads
+# tell() where they are and seek() back to resend a chunk.
+class FileRange:
+    def __init__(self, path, offset, length):
+        self._file = open(path, 'rb')
+        self._offset = offset
+        self._length = length
+        self._file.seek(offset)
+
+    def read(self, size=-1):
+        remaining = self._length - self.tell()
+        if size < 0 or size > remaining:
+            size = remaining
+        return self._file.read(max(size, 0))
+
+    def tell(self):
+        return self._file.tell() - self._offset
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.tell()
+        elif whence == os.SEEK_END:
+            position += self._length
+        position = min(max(position, 0), self._length)
+        self._file.seek(self._offset + position)
+        return position
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._file.close()
+
+class Uploader:
+    def __init__(self, bucket, manifest, workers=UPLOAD_WORKERS, compress=False,
+                 composite_threshold=COMPOSITE_THRESHOLD, part_size=PART_SIZE):
+        self.bucket = bucket
+        self.manifest = manifest
+        self.workers = workers
+        self.compress = compress
+        self.composite_threshold = composite_threshold
+        self.part_size = part_size
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._part_pool = None
+
+    def upload_folder(self, source_folder):
+        pending = []
+        for root, _, files in os.walk(source_folder):
+            for file_name in files:
+                local_file_path = os.path.join(root, file_name)
+                blob_name = os.path.relpath(local_file_path, source_folder).replace(os.sep, '/')
+                if self.manifest.is_current(blob_name, local_file_path, os.stat(local_file_path), self.compress):
+                    self.skipped += 1
+                else:
+                    pending.append((local_file_path, blob_name))
+
+        # Parts of large files go to their own pool: a file task waiting on
+        # its parts must never hold the worker one of them needs
+        self._part_pool = ThreadPoolExecutor(self.workers, thread_name_prefix="upload-part")
+        with self._part_pool, ThreadPoolExecutor(self.workers, thread_name_prefix="upload") as pool:
+            futures = {pool.submit(self.upload_file, path, blob_name): blob_name
+                       for path, blob_name in pending}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"Failed to upload {futures[future]}: {e}")
+                    print(f"Failed to upload {futures[future]}: {e}")
+        self.manifest.save()
+
+    def upload_file(self, path, blob_name):
+        stat = os.stat(path)
+        sha256 = file_hash(path)
+        source = path
+        if self.compress:
+            source = self._compress(path)
+        try:
+            size = os.path.getsize(source)
+            if size >= self.composite_threshold:
+                self._upload_composite(source, blob_name, size, path)
+            else:
+                blob = self._blob(blob_name, path, size)
+                blob.upload_from_filename(source, content_type=content_type(path))
+        finally:
+            if source != path:
+                os.remove(source)
+        self.manifest.record(blob_name, stat, sha256, self.compress)
+        with self._lock:
+            self.uploaded += 1
+            self.bytes_sent += size
+        logging.info(f"File {path} uploaded as {blob_name}")
+
+    def _blob(self, blob_name, path, size=0):
+        blob = self.bucket.blob(blob_name)
+        if size > CHUNK_SIZE:
+            blob.chunk_size = CHUNK_SIZE  # Resumable upload in chunks; small files go in one request
+        if self.compress:
+            blob.content_encoding = 'gzip'
+        return blob
+
+    def _compress(self, path):
+        fd, compressed = tempfile.mkstemp(suffix=".gz")
+        with os.fdopen(fd, 'wb') as out, open(path, 'rb') as f, gzip.GzipFile(fileobj=out, mode='wb') as gz:
+            shutil.copyfileobj(f, gz, 1 << 20)
+        return compressed
+
+    # Upload byte ranges as temporary part blobs in parallel, then compose
+    # them into the final blob
+    def _upload_composite(self, source, blob_name, size, path):
+        part_size = max(self.part_size, math.ceil(size / MAX_COMPOSE_SOURCES))
+        offsets = range(0, size, part_size)
+        parts = [self._blob(f"{blob_name}.part-{i:02d}", path, part_size) for i in range(len(offsets))]
+
+        def upload_part(blob, offset):
+            length = min(part_size, size - offset)
+            data = FileRange(source, offset, length)
+            try:
+                blob.upload_from_file(data, size=length)
+            finally:
+                data.close()
+
+        futures = [self._part_pool.submit(upload_part, blob, offset) for blob, offset in zip(parts, offsets)]
+        try:
+            for future in futures:
+                future.result()
+            blob = self._blob(blob_name, path)
+            blob.content_type = content_type(path)
+            blob.compose(parts)
+        finally:
+            for part in parts:
+                try:
+                    part.delete()
+                except Exception as e:
+                    logging.error(f"Failed to delete part {part.name}: {e}")
+
+# Bucket stored in a local directory, with the parts of the blob API the
+# uploader uses. `latency` adds a delay per request to stand in for the
+# network round trip.
+class FakeBucket:
+    def __init__(self, directory, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+        os.makedirs(directory, exist_ok=True)
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+        self.content_type = None
+        self.content_encoding = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.directory, self.name)
+
+    def _request(self):
+        if self.bucket.latency:
+            time.sleep(self.bucket.latency)
+
+    def upload_from_file(self, file_obj, size=None, content_type=None):
+        self._request()
+        if self.chunk_size:
+            file_obj.tell()  # Resumable uploads track their position, as in google-cloud-storage
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", 'wb') as f:
+            remaining = size
+            while remaining is None or remaining > 0:
+                chunk = file_obj.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+        os.replace(self.path + ".tmp", self.path)
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, 'rb') as f:
+            self.upload_from_file(f, content_type=content_type)
+
+    def compose(self, sources):
+        self._request()
+        with open(self.path + ".tmp", 'wb') as out:
+            for source in sources:
+                with open(source.path, 'rb') as f:
+                    shutil.copyfileobj(f, out, 1 << 20)
+        os.replace(self.path + ".tmp", self.path)
+
+    def delete(self):
+        self._request()
+        os.remove(self.path)
+
+def upload_to_gcs(bucket_name, source_folder, workers=UPLOAD_WORKERS, compress=False, manifest_path=MANIFEST_FILE):
+    return upload(gcs_bucket(bucket_name), source_folder, workers, compress, manifest_path)
+
+def upload(bucket, source_folder, workers=UPLOAD_WORKERS, compress=False, manifest_path=MANIFEST_FILE):
+    uploader = Uploader(bucket, Manifest(manifest_path), workers, compress)
+    start = time.perf_counter()
+    uploader.upload_folder(source_folder)
+    elapsed = time.perf_counter() - start
+    print(f"Uploaded {uploader.uploaded} files ({uploader.bytes_sent / 1e6:.1f} MB) in {elapsed:.1f}s, "
+          f"skipped {uploader.skipped} unchanged, {uploader.failed} failed")
+    return uploader
 
-def upload_to_gcs(bucket_name, source_folder):
-    bucket = client.get_bucket(bucket_name)
+# Upload `count` small files to a FakeBucket with `latency` seconds per
+# request, first with one worker and then with `workers`, and rerun once
+# to time the manifest check
+def bench_small_files(count=10000, size=4096, workers=UPLOAD_WORKERS, latency=0.005):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source")
+        os.makedirs(source)
+        for i in range(count):
+            with open(os.path.join(source, f"recording_{i:05d}.gyro"), 'wb') as f:
+                f.write(os.urandom(size))
 
-    for root, _, files in os.walk(source_folder):
-        for file_name in files:
-            local_file_path = os.path.join(root, file_name)
-            blob_name = os.path.relpath(local_file_path, source_folder)
-            
-            # Upload file with JSON metadata
-            blob = bucket.blob(blob_name)
-            blob.upload_from_filename(local_file_path, content_type='application/json')
+        for label, pool_size in (("serial", 1), (f"{workers} workers", workers)):
+            bucket = FakeBucket(os.path.join(tmp, f"bucket-{pool_size}"), latency)
+            manifest = os.path.join(tmp, f"manifest-{pool_size}.json")
+            start = time.perf_counter()
+            Uploader(bucket, Manifest(manifest), pool_size).upload_folder(source)
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {count / elapsed:,.0f} files/s, {count * size / elapsed / 1e6:.1f} MB/s")
 
-            print(f"File {file_name} uploaded to {bucket_name} as {blob_name}")
+        start = time.perf_counter()
+        rerun = Uploader(bucket, Manifest(manifest), workers)
+        rerun.upload_folder(source)
+        print(f"rerun: {rerun.skipped} unchanged files checked in {time.perf_counter() - start:.2f}s")
 
 if __name__ == "__main__":
-    source_folder = "/home/ecvxevv/fall-detection/mqtt-subscribe/datasets"  # Local directory path containing files to upload
-    bucket_name = "group3-falldetection"    
+    parser = argparse.ArgumentParser(description="Upload the dataset folder to a GCS bucket")
+    parser.add_argument("source", nargs="?", default=SOURCE_FOLDER)
+    parser.add_argument("--bucket", default=BUCKET_NAME)
+    parser.add_argument("--fake-bucket", default=None, help="upload into this local directory instead of GCS")
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS)
+    parser.add_argument("--gzip", action="store_true", help="compress files on upload")
+    parser.add_argument("--manifest", default=MANIFEST_FILE)
+    parser.add_argument("--benchmark", type=int, default=0, metavar="N",
+                        help="time N small-file uploads to a fake bucket instead")
+    parser.add_argument("--latency", type=float, default=None,
+                        help="fake bucket delay per request in seconds (default 0, 0.005 for --benchmark)")
+    args = parser.parse_args()
 
-    upload_to_gcs(bucket_name, source_folder)
+    if args.benchmark:
+        bench_small_files(args.benchmark, workers=args.workers,
+                          latency=0.005 if args.latency is None else args.latency)
+    elif args.fake_bucket:
+        upload(FakeBucket(args.fake_bucket, args.latency or 0.0), args.source, args.workers, args.gzip, args.manifest)
+    else:
+        upload_to_gcs(args.bucket, args.source, args.workers, args.gzip, args.manifest)
@@ -0,0 +1,54 @@
+import struct
+import numpy as np
+
+# Wire formats for gyro samples on fall-detection/sensor/gyro.
+#
+# Legacy (13 bytes): 1-byte ASCII device ID + gyX, gyY, gyZ as float32.
+#
+# Framed v1: an 8-byte header followed by `count` packed samples.
+#   version     uint8   FRAME_VERSION
+#   device_id   uint8   same ASCII ID byte as the legacy format
+#   seq         uint16  sequence number of the first sample, wraps at 65536
+#   sample_rate uint16  Hz
+#   count       uint16  number of samples in the frame
+#   samples     count * (gyX, gyY, gyZ) little-endian float32
+#
+# A framed message is never 13 bytes long (8 + 12 * count), and its first
+# byte is not a printable ID, so both formats can share one topic.
+LEGACY_PAYLOAD_SIZE = 13
+LEGACY_SAMPLE = struct.Struct('<fff')
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct('<BBHHH')
+SAMPLE_DTYPE = np.dtype('<f4')
+SAMPLE_SIZE = 3 * SAMPLE_DTYPE.itemsize
+
+# Decode one MQTT payload into (device_id, seq, sample_rate, samples).
+# samples is a (count, 3) float32 array, a read-only view of the payload
+# for frames; seq and sample_rate are None for legacy messages.
+def decode_payload(payload):
+    if len(payload) == LEGACY_PAYLOAD_SIZE:
+        # struct beats np.frombuffer for a single sample
+        samples = np.array([LEGACY_SAMPLE.unpack_from(payload, 1)], dtype=np.float32)
+        return chr(payload[0]), None, None, samples
+
+    if len(payload) < FRAME_HEADER.size:
+        raise ValueError(f"Payload too short: {len(payload)} bytes")
+    version, device_id, seq, sample_rate, count = FRAME_HEADER.unpack_from(payload)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+    expected = FRAME_HEADER.size + count * SAMPLE_SIZE
+    if len(payload) != expected:
+        raise ValueError(f"Frame length {len(payload)} does not match {count} samples ({expected} bytes)")
+    samples = np.frombuffer(payload, dtype=SAMPLE_DTYPE, count=3 * count, offset=FRAME_HEADER.size)
+    return chr(device_id), seq, sample_rate, samples.reshape(count, 3)
+
+# Encode samples as a framed v1 message, or a legacy message for a single
+# sample when legacy=True
+def encode_payload(device_id, samples, seq=0, sample_rate=100, legacy=False):
+    samples = np.asarray(samples, dtype=SAMPLE_DTYPE).reshape(-1, 3)
+    if legacy:
+        if len(samples) != 1:
+            raise ValueError("Legacy messages carry exactly one sample")
+        return device_id.encode('ascii') + samples.tobytes()
+    header = FRAME_HEADER.pack(FRAME_VERSION, ord(device_id), seq % 65536, sample_rate, len(samples))
+    return header + samples.tobytes()
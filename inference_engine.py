@@ -0,0 +1,190 @@
+import logging
+import queue
+import threading
+import time
+import numpy as np
+from metrics import Counter, Histogram, Gauge
+from model_runtime import fit_input
+
+INFERENCE_SECONDS = Histogram("inference_batch_seconds", "Model run time per batch")
+BATCH_SIZE = Histogram("inference_batch_size", "Windows per inference batch", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+PENDING_WINDOWS = Gauge("inference_pending_windows", "Windows waiting for the next batch")
+SHADOW_WINDOWS = Counter("shadow_windows_total", "Windows run through the shadow model, by agreement with the primary")
+SHADOW_SKIPPED = Counter("shadow_batches_skipped_total", "Batches the shadow model was too busy to run")
+SHADOW_SECONDS = Histogram("shadow_inference_batch_seconds", "Shadow model run time per batch")
+
+# Stop whatever a model runs in the background, such as the file watcher of
+# a ReloadingRuntime
+def close_model(model):
+    if hasattr(model, 'close'):
+        model.close()
+
+# Collects the windows of all devices that are ready and runs them through
+# the model as one (N, 3, window, 1) batch, then hands every row of the
+# result back to the device it came from through `on_result`.
+#
+# A batch is started as soon as `max_batch_size` windows are pending, or
+# `max_wait` seconds after the first pending window arrived. A device that
+# submits again before its previous window ran only keeps the newest one.
+#
+# With a `shadow` (ShadowModel), every batch is also offered to a second
+# model for comparison once its results have been handed out.
+class BatchInferenceEngine:
+    def __init__(self, model, on_result, window_size=120, max_batch_size=64, max_wait=0.05, shadow=None):
+        self.model = model
+        self.on_result = on_result
+        self.shadow = shadow
+        self.window_size = window_size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = {}  # device_id -> (window, context)
+        self._first_pending_at = None
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        PENDING_WINDOWS.set_function(self.pending)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="inference", daemon=True)
+        self._thread.start()
+        if self.shadow is not None:
+            self.shadow.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self.shadow is not None:
+            self.shadow.stop()
+        close_model(self.model)
+
+    def submit(self, device_id, window, context=None):
+        with self._cond:
+            if not self._pending:
+                self._first_pending_at = time.monotonic()
+            self._pending[device_id] = (window, context)
+            if len(self._pending) >= self.max_batch_size or len(self._pending) == 1:
+                self._cond.notify()
+
+    def pending(self):
+        return len(self._pending)
+
+    def predict(self, batch):
+        # Call the model runtime directly; Keras predict() sets up a data
+        # pipeline per call, which costs more than the model at this size
+        return np.asarray(self.model(batch))
+
+    def _next_batch(self):
+        with self._cond:
+            while self._running:
+                if self._pending:
+                    remaining = self._first_pending_at + self.max_wait - time.monotonic()
+                    if len(self._pending) >= self.max_batch_size or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            if not self._running:
+                return []
+            device_ids = list(self._pending)[:self.max_batch_size]
+            batch = [(device_id, *self._pending.pop(device_id)) for device_id in device_ids]
+            self._first_pending_at = time.monotonic() if self._pending else None
+            return batch
+
+    def _run(self):
+        while self._running:
+            jobs = self._next_batch()
+            if not jobs:
+                continue
+            try:
+                inputs = np.empty((len(jobs), 3, self.window_size, 1), dtype=np.float32)
+                for i, (_, window, _) in enumerate(jobs):
+                    inputs[i, :, :, 0] = window
+                started = time.perf_counter()
+                predictions = self.predict(inputs)
+                elapsed = time.perf_counter() - started
+                INFERENCE_SECONDS.observe(elapsed)
+                BATCH_SIZE.observe(len(jobs))
+            except Exception as e:
+                logging.error(f"Batch inference failed for {len(jobs)} windows: {e}")
+                continue
+            for (device_id, _, context), prediction in zip(jobs, predictions):
+                try:
+                    self.on_result(device_id, prediction, context)
+                except Exception as e:
+                    logging.error(f"Error handling prediction for device {device_id}: {e}")
+            if self.shadow is not None:
+                self.shadow.compare(inputs, predictions, elapsed)
+
+# Runs a second model on the batches of the primary one, on its own thread,
+# and reports how often the two disagree on the class and how much slower
+# or faster the shadow is. Batches are offered without waiting: while the
+# shadow is busy with `max_pending` of them, new ones are skipped, so the
+# primary path never slows down for it. A shadow taking another window
+# length than the primary (allnewfall-detect-model.h5 takes 25 samples)
+# gets each batch resampled to it, which counts towards its latency.
+class ShadowModel:
+    def __init__(self, model, name="shadow", max_pending=2, report_interval=60):
+        self.model = model
+        self.name = name
+        self.report_interval = report_interval
+        self.batches = 0
+        self.windows = 0
+        self.disagreements = 0
+        self.skipped = 0
+        self._latency_delta = 0.0  # Summed (shadow - primary) seconds per batch
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"inference-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self.report()
+        close_model(self.model)
+
+    def compare(self, inputs, predictions, primary_seconds):
+        try:
+            self._queue.put_nowait((inputs, predictions, primary_seconds))
+        except queue.Full:
+            self.skipped += 1
+            SHADOW_SKIPPED.inc(model=self.name)
+
+    def report(self):
+        if self.windows:
+            logging.info(f"Shadow model {self.name}: disagrees on {self.disagreements / self.windows:.2%} "
+                         f"of {self.windows} windows, {self._latency_delta / self.batches * 1000:+.3f} ms "
+                         f"per batch vs primary, {self.skipped} batches skipped")
+
+    def _run(self):
+        last_report = time.monotonic()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            inputs, predictions, primary_seconds = item
+            try:
+                started = time.perf_counter()
+                shadow_predictions = np.asarray(self.model(fit_input(inputs, getattr(self.model, 'input_shape', None))))
+                elapsed = time.perf_counter() - started
+            except Exception as e:
+                logging.error(f"Shadow model {self.name} failed on a batch of {len(inputs)}: {e}")
+                continue
+            SHADOW_SECONDS.observe(elapsed, model=self.name)
+            disagree = int(np.count_nonzero(shadow_predictions.argmax(axis=1) != predictions.argmax(axis=1)))
+            self.batches += 1
+            self.windows += len(inputs)
+            self.disagreements += disagree
+            self._latency_delta += elapsed - primary_seconds
+            SHADOW_WINDOWS.inc(len(inputs) - disagree, model=self.name, result="agree")
+            SHADOW_WINDOWS.inc(disagree, model=self.name, result="disagree")
+            if time.monotonic() - last_report >= self.report_interval:
+                self.report()
+                last_report = time.monotonic()
@@ -0,0 +1,198 @@
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from inference_engine import BatchInferenceEngine, INFERENCE_SECONDS, BATCH_SIZE, close_model
+from model_runtime import load_runtime
+
+# Batch inference on a pool of worker processes, so the model never runs
+# under the GIL next to the MQTT network loop.
+#
+# Batching works exactly as in BatchInferenceEngine. Each batch is written
+# into one slot of a shared-memory array and only (slot, size) is sent to
+# the workers; every worker process loads its own copy of the model and is
+# pinned to one core. When all slots are in flight the dispatcher waits,
+# and pending windows keep being replaced by newer ones per device. A
+# supervisor thread restarts workers that die and re-queues the batch they
+# were running once.
+#
+# A `shadow` model runs in this process on a copy of each batch, see
+# ShadowModel; its latency is compared against the dispatch-to-result time
+# of the batch on the pool.
+#
+# Workers are started with the 'spawn' method, so the script creating the
+# pool must keep its startup code under `if __name__ == "__main__":`.
+class WorkerPoolEngine(BatchInferenceEngine):
+    def __init__(self, model_path, on_result, window_size=120, max_batch_size=64, max_wait=0.05,
+                 workers=None, backend=None, loader=load_runtime, shadow=None):
+        super().__init__(None, on_result, window_size, max_batch_size, max_wait, shadow)
+        self.model_path = model_path
+        self.backend = backend
+        self.loader = loader
+        self.workers = workers or os.cpu_count()
+        self.max_inflight = 2 * self.workers
+        self._ctx = mp.get_context('spawn')
+        self._processes = []
+        self._inflight = {}  # slot -> (jobs, attempts, tag)
+        self._tag = 0  # Numbers every dispatch, so a stale result is never matched to a newer batch
+        self._inflight_lock = threading.Lock()
+        self._dispatched = {}  # slot -> dispatch time, for the batch latency metric
+
+    def start(self):
+        shape = (self.max_inflight, self.max_batch_size, 3, self.window_size, 1)
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+        self._inputs = np.ndarray(shape, dtype=np.float32, buffer=self._shm.buf)
+        self._jobs = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._current = self._ctx.Array('i', [-1] * self.workers, lock=False)
+        self._free_slots = queue.Queue()
+        for slot in range(self.max_inflight):
+            self._free_slots.put(slot)
+
+        self._processes = [self._spawn(index) for index in range(self.workers)]
+        super().start()
+        self._collector = threading.Thread(target=self._collect, name="inference-results", daemon=True)
+        self._collector.start()
+        self._supervisor = threading.Thread(target=self._supervise, name="inference-supervisor", daemon=True)
+        self._supervisor.start()
+
+    def stop(self):
+        super().stop()
+        for _ in self._processes:
+            self._jobs.put(None)
+        for process in self._processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self._collector.join()
+        self._supervisor.join()
+        self._inputs = None
+        self._shm.close()
+        self._shm.unlink()
+
+    def _spawn(self, index):
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        cpu = cpus[index % len(cpus)] if cpus else None
+        process = self._ctx.Process(
+            target=_worker_main, name=f"inference-worker-{index}", daemon=True,
+            args=(index, cpu, self.model_path, self.backend, self.loader, self._shm.name,
+                  self._inputs.shape, self._jobs, self._results, self._current))
+        process.start()
+        return process
+
+    # Dispatcher: overrides the in-process batch run
+    def _run(self):
+        while self._running:
+            jobs = self._next_batch()
+            if not jobs:
+                continue
+            slot = self._acquire_slot()
+            if slot is None:
+                break
+            for i, (_, window, _) in enumerate(jobs):
+                self._inputs[slot, i, :, :, 0] = window
+            with self._inflight_lock:
+                self._tag += 1
+                tag = self._tag
+                self._inflight[slot] = ([(device_id, context) for device_id, _, context in jobs], 0, tag)
+                self._dispatched[slot] = time.perf_counter()
+            self._jobs.put((slot, len(jobs), tag))
+
+    def _acquire_slot(self):
+        # Back-pressure: wait while every slot is in flight
+        while self._running:
+            try:
+                return self._free_slots.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def _collect(self):
+        while self._running or self._inflight:
+            try:
+                slot, tag, predictions, error = self._results.get(timeout=0.5)
+            except queue.Empty:
+                if not self._running:
+                    break
+                continue
+            with self._inflight_lock:
+                entry = self._inflight.get(slot)
+                if entry is None or entry[2] != tag:
+                    # A batch answered twice: its worker died after sending the
+                    # result and the retry ran too. The slot was freed already
+                    # and may hold a newer batch now.
+                    continue
+                del self._inflight[slot]
+                jobs = entry[0]
+                dispatched = self._dispatched.pop(slot)
+            # The slot is reused as soon as it is freed
+            inputs = self._inputs[slot, :len(jobs)].copy() if self.shadow is not None and error is None else None
+            self._free_slots.put(slot)
+            if error is not None:
+                logging.error(f"Batch inference failed for {len(jobs)} windows: {error}")
+                continue
+            elapsed = time.perf_counter() - dispatched
+            INFERENCE_SECONDS.observe(elapsed)
+            BATCH_SIZE.observe(len(jobs))
+            for (device_id, context), prediction in zip(jobs, predictions):
+                try:
+                    self.on_result(device_id, prediction, context)
+                except Exception as e:
+                    logging.error(f"Error handling prediction for device {device_id}: {e}")
+            if inputs is not None:
+                self.shadow.compare(inputs, np.asarray(predictions), elapsed)
+
+    def _supervise(self):
+        while self._running:
+            time.sleep(1)
+            for index, process in enumerate(self._processes):
+                if process.is_alive() or not self._running:
+                    continue
+                slot = self._current[index]
+                self._current[index] = -1
+                logging.error(f"Inference worker {index} exited with code {process.exitcode}, restarting")
+                if slot >= 0:
+                    self._retry(slot)
+                self._processes[index] = self._spawn(index)
+
+    def _retry(self, slot):
+        with self._inflight_lock:
+            if slot not in self._inflight:
+                return
+            jobs, attempts, tag = self._inflight[slot]
+            if attempts == 0:
+                # Same tag: whichever result of the batch arrives first is used
+                self._inflight[slot] = (jobs, 1, tag)
+                self._jobs.put((slot, len(jobs), tag))
+                return
+            del self._inflight[slot]
+            self._dispatched.pop(slot, None)
+        logging.error(f"Dropping batch of {len(jobs)} windows after it crashed a worker twice")
+        self._free_slots.put(slot)
+
+def _worker_main(index, cpu, model_path, backend, loader, shm_name, shape, jobs, results, current):
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    model = loader(model_path, backend)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    inputs = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            slot, size, tag = job
+            current[index] = slot
+            try:
+                results.put((slot, tag, np.asarray(model(inputs[slot, :size])), None))
+            except Exception as e:
+                results.put((slot, tag, None, str(e)))
+            current[index] = -1
+    finally:
+        del inputs
+        shm.close()
+        close_model(model)
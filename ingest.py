@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import paho.mqtt.client as mqtt
+from metrics import Counter, Gauge
+
+# Shared MQTT ingest core for the subscriber scripts.
+#
+# paho runs the network loop of every broker connection on its own thread
+# and does nothing in on_message except hand the message to an asyncio loop.
+# The loop fans each message out to the sinks whose topic filters match.
+# Every sink has its own bounded queue and consumer, so a slow sink only
+# fills (and then drops the oldest entries of) its own queue and never
+# stalls the socket or the other sinks. Plain-function sinks run on a
+# dedicated thread so they may block; coroutine sinks run on the loop.
+
+# Brokers as "host:port" pairs separated by commas
+MQTT_BROKERS = os.environ.get('MQTT_BROKERS', '34.143.200.120:1883')
+GYRO_TOPIC = "fall-detection/sensor/gyro"
+
+# How often queue depths and drop counts are logged (seconds)
+REPORT_INTERVAL = 60
+
+QUEUE_DEPTH = Gauge("ingest_queue_depth", "Messages waiting in each sink queue")
+DROPPED = Counter("ingest_dropped_total", "Messages dropped because a sink queue was full")
+
+Message = namedtuple('Message', ['topic', 'payload', 'broker', 'received'])
+
+def parse_brokers(value):
+    brokers = []
+    for entry in value.split(','):
+        host, _, port = entry.strip().partition(':')
+        brokers.append((host, int(port or 1883)))
+    return brokers
+
+class Sink:
+    def __init__(self, name, handler, topics, queue_size):
+        self.name = name
+        self.handler = handler
+        self.topics = topics
+        self.queue_size = queue_size
+        self.queue = None
+        self.dropped = 0
+        self.processed = 0
+
+    def matches(self, topic):
+        return any(mqtt.topic_matches_sub(topic_filter, topic) for topic_filter in self.topics)
+
+class IngestCore:
+    def __init__(self, topics=(GYRO_TOPIC,), brokers=None, report_interval=REPORT_INTERVAL):
+        self.topics = list(topics)
+        self.brokers = parse_brokers(MQTT_BROKERS) if brokers is None else brokers
+        self.report_interval = report_interval
+        self.sinks = []
+        self._clients = []
+        self._loop = None
+        self._stopped = None
+        self._thread = None
+
+    # Register `handler(message)` for messages on `topics` (default: all
+    # topics of the core). Must be called before the core starts.
+    def add_sink(self, name, handler, topics=None, queue_size=1000):
+        sink = Sink(name, handler, topics or self.topics, queue_size)
+        self.sinks.append(sink)
+        QUEUE_DEPTH.set_function(lambda: sink.queue.qsize() if sink.queue is not None else 0, sink=name)
+        return sink
+
+    def queue_depths(self):
+        return {sink.name: sink.queue.qsize() if sink.queue is not None else 0 for sink in self.sinks}
+
+    async def run(self, ready=None):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        for sink in self.sinks:
+            sink.queue = asyncio.Queue(maxsize=sink.queue_size)
+        tasks = [asyncio.create_task(self._consume(sink)) for sink in self.sinks]
+        tasks.append(asyncio.create_task(self._report()))
+        self._clients = [self._connect(host, port) for host, port in self.brokers]
+        if ready is not None:
+            ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            for client in self._clients:
+                client.loop_stop()
+                client.disconnect()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Feed a message in without a broker, e.g. from a replay or benchmark;
+    # safe to call from any thread once the core is running
+    def inject(self, topic, payload, broker="local"):
+        message = Message(topic, payload, broker, time.time())
+        self._loop.call_soon_threadsafe(self._dispatch, message)
+
+    # Run the core on a background thread
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=asyncio.run, args=(self.run(ready),), name="mqtt-ingest", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread is not None:
+            self._thread.join()
+
+    # Run the core on the calling thread until interrupted
+    def run_forever(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            logging.info("Ingest stopped by user.")
+
+    def _connect(self, host, port):
+        broker = f"{host}:{port}"
+        client = mqtt.Client()
+
+        def on_connect(client, userdata, flags, rc):
+            logging.info(f"Connected to {broker} with result code {rc}")
+            client.subscribe([(topic, 0) for topic in self.topics])
+
+        def on_message(client, userdata, msg):
+            message = Message(msg.topic, msg.payload, broker, time.time())
+            self._loop.call_soon_threadsafe(self._dispatch, message)
+
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect_async(host, port, 60)
+        client.loop_start()
+        return client
+
+    def _dispatch(self, message):
+        for sink in self.sinks:
+            if not sink.matches(message.topic):
+                continue
+            if sink.queue.full():
+                sink.queue.get_nowait()  # Drop the oldest message for this sink only
+                sink.dropped += 1
+                DROPPED.inc(sink=sink.name)
+            sink.queue.put_nowait(message)
+
+    async def _consume(self, sink):
+        executor = None
+        if not asyncio.iscoroutinefunction(sink.handler):
+            executor = ThreadPoolExecutor(1, thread_name_prefix=f"sink-{sink.name}")
+        try:
+            while True:
+                message = await sink.queue.get()
+                try:
+                    if executor is None:
+                        await sink.handler(message)
+                    else:
+                        await self._loop.run_in_executor(executor, sink.handler, message)
+                    sink.processed += 1
+                except Exception as e:
+                    logging.error(f"Sink {sink.name} failed on message from {message.topic}: {e}")
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            for sink in self.sinks:
+                logging.info(f"Sink {sink.name}: queue depth {sink.queue.qsize()}/{sink.queue_size}, "
+                              f"processed {sink.processed}, dropped {sink.dropped}")
@@ -0,0 +1,250 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In-process metrics with Prometheus text exposition.
+#
+# Metrics are module-level objects registered in REGISTRY when created and
+# are safe to update from any thread. Labels are passed as keyword
+# arguments, e.g. SAMPLES.inc(len(samples), device=device_id). Expose them
+# with start_http_server() (GET /metrics) or log them periodically with
+# start_summary_logger().
+
+# Default histogram buckets in seconds, from 0.1 ms to 10 s
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "".join(metric.render() for metric in list(self.metrics))
+
+REGISTRY = Registry()
+
+# Label values are arbitrary (device IDs are raw bytes from the sensors), so
+# escape them as the text format requires
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + "}"
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}\n", f"# TYPE {self.name} {self.kind}\n"]
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{format_labels(labels)} {value}\n")
+        return "".join(lines)
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, registry=REGISTRY):
+        super().__init__(name, help, registry)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    # Read the value from `function` at collection time, e.g. a queue size
+    def set_function(self, function, **labels):
+        with self._lock:
+            self._functions[tuple(sorted(labels.items()))] = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                logging.error(f"Failed to collect gauge {self.name}: {e}")
+        return list(values.items())
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    # Context manager timing a block in seconds
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}\n", f"# TYPE {self.name} {self.kind}\n"]
+        for labels, (counts, total) in self.samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', le),))} {cumulative}\n")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}\n")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}\n")
+        return "".join(lines)
+
+    def samples(self):
+        with self._lock:
+            return [(key, ([*counts], total)) for key, (counts, total) in self._values.items()]
+
+    # Approximate quantile from the bucket counts (upper bound of the bucket)
+    def quantile(self, q, **labels):
+        with self._lock:
+            counts = self._values.get(tuple(sorted(labels.items())))
+            counts = list(counts[0]) if counts else None
+        if not counts or not sum(counts):
+            return None
+        target = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line each
+
+def start_http_server(port, host="0.0.0.0", registry=REGISTRY):
+    handler = type("MetricsHandler", (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+# Log one line per metric every `interval` seconds: counter totals, gauge
+# values and histogram count/p50/p99
+def start_summary_logger(interval=60, registry=REGISTRY):
+    def run():
+        while True:
+            time.sleep(interval)
+            for metric in list(registry.metrics):
+                logging.info(f"metrics {summarize(metric)}")
+    threading.Thread(target=run, name="metrics-summary", daemon=True).start()
+
+def summarize(metric):
+    if isinstance(metric, Histogram):
+        parts = []
+        for labels, (counts, total) in metric.samples():
+            count = sum(counts)
+            labels = dict(labels)
+            parts.append(f"{format_labels(sorted(labels.items()))} n={count} "
+                         f"mean={total / count if count else 0:.4f} "
+                         f"p50={metric.quantile(0.5, **labels)} p99={metric.quantile(0.99, **labels)}")
+        return f"{metric.name}: " + "; ".join(parts)
+    if isinstance(metric, Counter) and len(metric.samples()) > 10:
+        return f"{metric.name}: total={sum(value for _, value in metric.samples())} over {len(metric.samples())} series"
+    return f"{metric.name}: " + ", ".join(f"{format_labels(labels) or 'value'}={value}" for labels, value in metric.samples())
+
+# Logging filter that lets each call site (file and line) emit at most
+# `rate` records per `per` seconds, and reports how many were suppressed.
+#
+# Errors are limited too: the per-message failures that flood the log here
+# (undecodable payloads, a failing batch) are logged as errors, and the
+# first `rate` of every window plus the suppressed count still show them.
+# Records at `passthrough` or above are never limited.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=10, per=10.0, passthrough=logging.CRITICAL):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.passthrough = passthrough
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.passthrough:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            window_start, emitted, suppressed = self._sites.get(key, (now, 0, 0))
+            if now - window_start >= self.per:
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+                window_start, emitted, suppressed = now, 0, 0
+            if emitted < self.rate:
+                self._sites[key] = (window_start, emitted + 1, suppressed)
+                return True
+            self._sites[key] = (window_start, emitted, suppressed + 1)
+            return False
+
+# Rate-limit every handler of the root logger, replacing per-message lines
+# with at most `rate` per call site every `per` seconds
+def install_rate_limited_logging(rate=10, per=10.0, passthrough=logging.CRITICAL):
+    log_filter = RateLimitFilter(rate, per, passthrough)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(log_filter)
+    return log_filter
@@ -0,0 +1,300 @@
+import argparse
+import hashlib
+import importlib
+import logging
+import os
+import threading
+import time
+import numpy as np
+from resample import resample_windows
+
+# Pluggable inference backends for the .h5 models.
+#
+# Every runtime is a callable taking a float32 batch and returning class
+# probabilities as a NumPy array. The Keras backend needs full TensorFlow;
+# the TFLite and ONNX backends run a converted copy of the model that is
+# produced once (python model_runtime.py convert new_model.h5 --backend
+# tflite) and cached in MODEL_CACHE_DIR, so an edge box only needs the
+# small interpreter package. TensorFlow is only imported when a model is
+# loaded or converted through Keras.
+
+# keras, tflite, onnx, or auto: use a cached conversion when one exists and
+# its runtime is installed, otherwise fall back to Keras
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'auto')
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', '.model_cache')
+
+BACKEND_SUFFIXES = {'tflite': '.tflite', 'onnx': '.onnx'}
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+# Where the conversion of `path` for `backend` is cached; keyed by content
+# so replacing the .h5 file invalidates it
+def cached_model_path(path, backend, cache_dir=MODEL_CACHE_DIR):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}-{file_hash(path)}{BACKEND_SUFFIXES[backend]}")
+
+class KerasRuntime:
+    backend = 'keras'
+
+    def __init__(self, path):
+        from tensorflow.keras.models import load_model
+        self.path = path
+        self.model = load_model(path)
+        self.input_shape = tuple(self.model.input_shape)
+
+    def __call__(self, batch):
+        return np.asarray(self.model(batch, training=False))
+
+class TFLiteRuntime:
+    backend = 'tflite'
+
+    def __init__(self, path):
+        self.path = path
+        self.interpreter = load_tflite_interpreter()(model_path=path)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.input_shape = (None, *self._input['shape'][1:])
+        self._batch_size = int(self._input['shape'][0])
+        self._lock = threading.Lock()  # The interpreter is not thread-safe
+
+    def __call__(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        with self._lock:
+            if len(batch) != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input['index'], batch.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+            self.interpreter.set_tensor(self._input['index'], batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output['index']).copy()
+
+class OnnxRuntime:
+    backend = 'onnx'
+
+    def __init__(self, path):
+        import onnxruntime
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self._input = self.session.get_inputs()[0]
+        self.input_shape = tuple(None if isinstance(d, str) else d for d in self._input.shape)
+
+    def __call__(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        return self.session.run(None, {self._input.name: batch})[0]
+
+RUNTIMES = {'keras': KerasRuntime, 'tflite': TFLiteRuntime, 'onnx': OnnxRuntime}
+
+# The standalone tflite-runtime / ai-edge-litert packages are preferred;
+# full TensorFlow works too
+def load_tflite_interpreter():
+    for module, attribute in (('ai_edge_litert.interpreter', 'Interpreter'),
+                              ('tflite_runtime.interpreter', 'Interpreter'),
+                              ('tensorflow.lite', 'Interpreter')):
+        try:
+            return getattr(importlib.import_module(module), attribute)
+        except ImportError:
+            continue
+    raise ImportError("No TFLite interpreter installed (ai-edge-litert, tflite-runtime or tensorflow)")
+
+def backend_available(backend):
+    try:
+        if backend == 'tflite':
+            load_tflite_interpreter()
+        else:
+            importlib.import_module({'keras': 'tensorflow', 'onnx': 'onnxruntime'}[backend])
+        return True
+    except ImportError:
+        return False
+
+# Load the model at `path` (.h5) with the configured backend
+def load_runtime(path, backend=None, cache_dir=MODEL_CACHE_DIR):
+    backend = backend or MODEL_BACKEND
+    started = time.perf_counter()
+    if backend == 'auto':
+        backend = 'keras'
+        for candidate in ('tflite', 'onnx'):
+            if os.path.exists(cached_model_path(path, candidate, cache_dir)) and backend_available(candidate):
+                backend = candidate
+                break
+    if backend not in RUNTIMES:
+        raise ValueError(f"Unknown model backend {backend!r}, expected one of {sorted(RUNTIMES)} or 'auto'")
+
+    if backend == 'keras':
+        runtime = KerasRuntime(path)
+    else:
+        converted = cached_model_path(path, backend, cache_dir)
+        if not os.path.exists(converted):
+            convert_model(path, backend, cache_dir)
+        runtime = RUNTIMES[backend](converted)
+    logging.info(f"Loaded {path} with the {backend} backend in {time.perf_counter() - started:.2f}s")
+    return runtime
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+# Resample a (N, 3, window, 1) batch along time to the window length in
+# `input_shape` (None, 3, length, 1) when the model takes a different one,
+# e.g. 25 samples for allnewfall-detect-model.h5
+def fit_input(batch, input_shape):
+    length = input_shape[2] if input_shape is not None and len(input_shape) == 4 else None
+    if length is None or length == batch.shape[2]:
+        return batch
+    return resample_windows(batch, int(length))
+
+# Seconds between checks of a model file for a new version
+RELOAD_INTERVAL = 2.0
+
+# Runtime that follows its model file: a thread checks `path` every
+# `poll_interval` seconds and, once a changed file has stopped changing,
+# loads it in the background and swaps it in. A batch already running
+# finishes on the model it started with and the next one uses the new
+# model, so the swap never lands in the middle of a batch and the windows
+# held by the caller are untouched. Batches are resampled to the window
+# length of the running model (see fit_input()), so a model taking another
+# length, such as allnewfall-detect-model.h5 for new_model.h5, can be
+# swapped in too. A file that fails to load, or whose input differs in
+# anything but its length, is logged and ignored.
+#
+# Replace the model by copying or renaming over the watched path, or by
+# repointing a symlink at it. Every process reloads on its own, so the
+# workers of a WorkerPoolEngine may run different versions for up to a poll
+# interval plus the load time; each switch is logged with the process id
+# and the hash of the file. Call close() to stop the watcher.
+class ReloadingRuntime:
+    def __init__(self, path, backend=None, poll_interval=RELOAD_INTERVAL, loader=load_runtime):
+        self.path = path
+        self.backend_name = backend
+        self.poll_interval = poll_interval
+        self.loader = loader
+        self._signature = file_signature(path)
+        self.sha256 = file_hash(path)
+        self.runtime = loader(path, backend)
+        self.input_shape = getattr(self.runtime, 'input_shape', None)
+        self.version = 1
+        logging.info(f"Running {self.path} version 1 (sha256 {self.sha256}) in process {os.getpid()}")
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name="model-reload", daemon=True)
+        self._thread.start()
+
+    def __call__(self, batch):
+        runtime = self.runtime  # The input shape and the model must come from the same version
+        return runtime(fit_input(batch, getattr(runtime, 'input_shape', None)))
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _watch(self):
+        changed = None
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                signature = file_signature(self.path)
+            except FileNotFoundError:
+                continue  # Being replaced
+            if signature == self._signature:
+                changed = None
+            elif signature != changed:
+                changed = signature  # Wait one more interval in case it is still being written
+            else:
+                self._reload(signature)
+                changed = None
+
+    def _reload(self, signature):
+        self._signature = signature
+        try:
+            sha256 = file_hash(self.path)
+            runtime = self.loader(self.path, self.backend_name)
+        except Exception as e:
+            logging.error(f"Failed to reload {self.path}, keeping the running model: {e}")
+            return
+        input_shape = getattr(runtime, 'input_shape', None)
+        if self.input_shape is not None and input_shape is not None \
+                and (len(input_shape) != len(self.input_shape) or
+                     [d for i, d in enumerate(input_shape) if i != 2] !=
+                     [d for i, d in enumerate(self.input_shape) if i != 2]):
+            logging.error(f"Not reloading {self.path}: input shape {input_shape} does not match {self.input_shape}")
+            return
+        if input_shape is not None and self.input_shape is not None and input_shape != self.input_shape:
+            logging.info(f"{self.path} now takes input {input_shape}, resampling windows to it")
+        self.runtime = runtime
+        self.input_shape = input_shape
+        self.sha256 = sha256
+        self.version += 1
+        logging.info(f"Reloaded {self.path}, now running version {self.version} "
+                     f"(sha256 {sha256}) in process {os.getpid()}")
+
+# Loader for ReloadingRuntime that can be handed to worker processes
+def load_reloading_runtime(path, backend=None):
+    return ReloadingRuntime(path, backend)
+
+# Convert an .h5 model for `backend` and store it in the cache. Needs
+# TensorFlow (and tf2onnx for ONNX), so run it once on a build machine.
+def convert_model(path, backend, cache_dir=MODEL_CACHE_DIR):
+    import tensorflow as tf
+    model = tf.keras.models.load_model(path)
+    output = cached_model_path(path, backend, cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    if backend == 'tflite':
+        converted = tf.lite.TFLiteConverter.from_keras_model(model).convert()
+        with open(output + '.tmp', 'wb') as f:
+            f.write(converted)
+    elif backend == 'onnx':
+        import tf2onnx
+        spec = (tf.TensorSpec((None, *model.input_shape[1:]), tf.float32, name='input'),)
+        tf2onnx.convert.from_keras(model, input_signature=spec, output_path=output + '.tmp')
+    else:
+        raise ValueError(f"Backend {backend!r} has no converted form")
+    os.replace(output + '.tmp', output)
+    logging.info(f"Converted {path} to {output}")
+    return output
+
+# Compare a backend against Keras on random inputs shaped like the model
+# input: class agreement, largest probability difference, cold start and
+# per-window latency
+def check_parity(path, backend, samples=512, batch_size=32, cache_dir=MODEL_CACHE_DIR):
+    report = {}
+    runtimes = {}
+    for name in ('keras', backend):
+        started = time.perf_counter()
+        runtimes[name] = load_runtime(path, name, cache_dir)
+        report[f'{name}_load_s'] = time.perf_counter() - started
+
+    rng = np.random.default_rng(0)
+    shape = runtimes['keras'].input_shape[1:]
+    inputs = rng.normal(0, 100, size=(samples, *shape)).astype(np.float32)
+    outputs = {}
+    for name, runtime in runtimes.items():
+        runtime(inputs[:1])  # Warm up
+        started = time.perf_counter()
+        single = [runtime(inputs[i:i + 1]) for i in range(min(samples, 100))]
+        report[f'{name}_window_ms'] = (time.perf_counter() - started) / len(single) * 1000
+        started = time.perf_counter()
+        outputs[name] = np.concatenate([runtime(inputs[i:i + batch_size]) for i in range(0, samples, batch_size)])
+        report[f'{name}_batched_window_ms'] = (time.perf_counter() - started) / samples * 1000
+
+    report['class_agreement'] = float(np.mean(outputs['keras'].argmax(1) == outputs[backend].argmax(1)))
+    report['max_abs_diff'] = float(np.max(np.abs(outputs['keras'] - outputs[backend])))
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert .h5 models for a lightweight runtime and check parity")
+    parser.add_argument("command", choices=["convert", "parity"])
+    parser.add_argument("models", nargs="+")
+    parser.add_argument("--backend", choices=["tflite", "onnx"], default="tflite")
+    parser.add_argument("--cache-dir", default=MODEL_CACHE_DIR)
+    args = parser.parse_args()
+
+    for model_path in args.models:
+        if args.command == "convert":
+            print(f"{model_path} -> {convert_model(model_path, args.backend, args.cache_dir)}")
+        print(f"{model_path} ({args.backend} vs keras):")
+        for key, value in check_parity(model_path, args.backend, cache_dir=args.cache_dir).items():
+            print(f"  {key}: {value:.4f}")
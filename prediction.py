@@ -2,63 +2,101 @@ import json
 import numpy as np
 import logging
 import os
+import queue
+import threading
+import time
 os.environ['TF_TENSORRT_DISABLED'] = '1'
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from resample import to_columns, resample_columns
+from model_runtime import load_runtime
+from ingest import IngestCore
+from metrics import install_rate_limited_logging
 
 # Setup logging
-logging.basicConfig(filename='mqtt_client.log', level=logging.DEBUG, 
+logging.basicConfig(filename='mqtt_client.log', level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
+install_rate_limited_logging()
 
-# Load the pre-trained model
-model = load_model('model.h5')
+# Load the pre-trained model with the backend chosen by MODEL_BACKEND
+model = load_runtime('model.h5')
 
-# Define the handler to process file changes
-class JsonFileHandler(FileSystemEventHandler):
-    def __init__(self):
-        self.processing = False
+# Each message carries SOURCE_LENGTH points, upsampled to the model's WINDOW_SIZE
+SOURCE_LENGTH = 120
+WINDOW_SIZE = 600
+GYRO_FIELDS = ('gyX', 'gyY', 'gyZ')
 
-    def on_modified(self, event):
-        if event.src_path == "gyro_data.json" and not self.processing:
-            self.processing = True
-            logging.info(f"{event.src_path} has been modified")
-            process_json_data(event.src_path)
-            self.processing = False
+# Windows waiting for the predictor; when it falls behind the oldest are dropped
+WINDOW_QUEUE_SIZE = 32
 
-def process_json_data(file_path):
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    
-    if len(data) == 600:  # Ensure we have the correct number of data points
-        logging.info("Data has 600 points. Making prediction.")
-        prediction = make_prediction(data)
-        logging.info(f"Prediction: {prediction}")
+windows = queue.Queue(maxsize=WINDOW_QUEUE_SIZE)
 
-def make_prediction(data):
-    # Extract relevant fields and reshape for prediction
-    gyro_x = [point['gyX'] for point in data]
-    gyro_y = [point['gyY'] for point in data]
-    gyro_z = [point['gyZ'] for point in data]
+# Sink for the ingest core: validate, resample and hand the window to the
+# predictor thread. Every stage stamps its completion time.
+def on_message(msg):
+    timings = {'received': msg.received}
+    try:
+        data = json.loads(msg.payload.decode())
+        if not isinstance(data, list) or len(data) != SOURCE_LENGTH:
+            logging.error(f"Expected a list of {SOURCE_LENGTH} points, got {type(data).__name__} "
+                          f"of length {len(data) if isinstance(data, list) else 'n/a'}")
+            return
+        columns = to_columns(data, GYRO_FIELDS)
+        timings['decoded'] = time.time()
 
-    # Reshape data for model prediction
-    input_data = np.array([gyro_x, gyro_y, gyro_z]).T
-    input_data = input_data.reshape(1, input_data.shape[0], input_data.shape[1])
+        window = resample_columns(columns, WINDOW_SIZE)  # (3, 600)
+        timings['resampled'] = time.time()
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error(f"Failed to decode window: {e}")
+        return
+
+    item = (data[0].get('ID'), window, timings)
+    while True:
+        try:
+            windows.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                windows.get_nowait()
+                logging.warning("Predictor is behind, dropped the oldest window")
+            except queue.Empty:
+                pass
+
+def make_prediction(window):
+    # model.h5 takes (None, 3, 600, 1): channels by samples, one filter channel
+    input_data = window.reshape(1, window.shape[0], window.shape[1], 1).astype(np.float32)
 
     # Make prediction
-    prediction = model.predict(input_data)
+    prediction = model(input_data)
     return prediction
 
-# Setup the watchdog observer
-event_handler = JsonFileHandler()
-observer = Observer()
-observer.schedule(event_handler, path='.', recursive=False)
-observer.start()
+# Predictor loop: blocks on the queue, so it uses no CPU while idle
+def run_predictor(stop_event):
+    while not stop_event.is_set():
+        try:
+            device_id, window, timings = windows.get(timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            prediction = make_prediction(window)
+            timings['predicted'] = time.time()
+        except Exception as e:
+            logging.error(f"Prediction failed for device {device_id}: {e}")
+            continue
 
+        received = timings['received']
+        stages = ", ".join(f"{stage} +{(stamp - received) * 1000:.1f} ms"
+                           for stage, stamp in timings.items() if stage != 'received')
+        logging.info(f"Device {device_id} prediction: {prediction} ({stages})")
+
+# Receive messages through the shared ingest core on a background thread
+core = IngestCore()
+core.add_sink("predictor", on_message, queue_size=WINDOW_QUEUE_SIZE)
+core.start()
+
+logging.info("Starting prediction pipeline")
+stop_event = threading.Event()
 try:
-    while True:
-        pass
+    run_predictor(stop_event)
 except KeyboardInterrupt:
-    observer.stop()
-observer.join()
\ No newline at end of file
+    stop_event.set()
+    logging.info("Script terminated by user.")
+core.stop()
@@ -1,22 +1,79 @@
-import json
 import numpy as np
 import logging
-import os
 import time
-import psycopg2
-from threading import Timer
-from tensorflow.keras.models import load_model
-import paho.mqtt.client as mqtt
+from datetime import datetime
+from psycopg2.pool import ThreadedConnectionPool
+from device_registry import DeviceRegistry
+from inference_engine import BatchInferenceEngine, ShadowModel
+from gyro_protocol import decode_payload
+from event_writer import FallEventWriter
+from alert_tracker import FallEventTracker
+from alert_publisher import AlertPublisher
+from activity_gate import load_gate, ACTIVITY_GATE_FILE
+from inference_pool import WorkerPoolEngine
+from model_runtime import load_runtime, load_reloading_runtime
+from ensemble import load_ensemble
+from ingest import IngestCore
+from metrics import Counter, Gauge, Histogram, start_http_server, start_summary_logger, install_rate_limited_logging
 
 # Setup logging
 logging.basicConfig(filename='mqtt_client.log', level=logging.DEBUG, 
                     format='%(asctime)s %(levelname)s %(message)s')
-
-# Load the pre-trained model
-model = load_model('new_model.h5')
-
-# Define the interval for predictions (in seconds)
-PREDICTION_INTERVAL = 0.5
+install_rate_limited_logging()
+
+# Pre-trained model, loaded with the backend chosen by MODEL_BACKEND.
+# Replacing the file swaps the new model in between batches, without a
+# restart; windows are resampled if the new model takes another length.
+MODEL_PATH = 'new_model.h5'
+
+# Candidate model (e.g. 'allnewfall-detect-model.h5') run on the same batches
+# as MODEL_PATH, resampled to its input length, to log how often it
+# disagrees and its latency difference; its predictions never reach the
+# alerts. None disables it.
+SHADOW_MODEL_PATH = None
+
+# Run several models on every batch instead of MODEL_PATH alone, as
+# (path, weight) pairs, combining their class probabilities by
+# ENSEMBLE_RULE: 'weighted' (weighted mean) or 'vote' (weighted majority).
+# Each model gets the same window resampled to its own input length, e.g.
+# [('new_model.h5', 1.0), ('model.h5', 1.0), ('allnewfall-detect-model.h5', 1.0)].
+# None runs MODEL_PATH only.
+ENSEMBLE_MODELS = None
+ENSEMBLE_RULE = 'weighted'
+
+# Run a prediction for a device every PREDICTION_HOP new samples
+PREDICTION_HOP = 20
+
+# Number of samples the model looks at and samples kept per device
+WINDOW_SIZE = 120
+MAX_DATA_POINTS = 1200
+
+# Upper bound on concurrently tracked belts and how long an idle one is kept
+MAX_DEVICES = 512
+DEVICE_IDLE_TIMEOUT = 300
+
+# Gaps of up to MAX_GAP_FILL missing samples are interpolated; longer ones,
+# or a legacy device silent for GAP_TIMEOUT seconds, invalidate the windows
+# that span them
+MAX_GAP_FILL = 10
+GAP_TIMEOUT = 0.25
+
+# Largest batch handed to the model and the longest a ready window waits for one
+MAX_BATCH_SIZE = 64
+MAX_BATCH_WAIT = 0.05
+
+# 0 runs inference on a thread in this process; N > 0 (or None for one per
+# core) runs it on N worker processes fed through shared memory
+INFERENCE_WORKERS = 0
+
+# Consecutive fall windows of a device are merged into one fall event: it
+# opens once ALERT_K of the last ALERT_N windows are falls, and after it
+# ends the device stays quiet for ALERT_REFRACTORY seconds. An event whose
+# device sends no window for ALERT_MAX_GAP seconds is ended.
+ALERT_K = 1
+ALERT_N = 1
+ALERT_REFRACTORY = 5.0
+ALERT_MAX_GAP = 2.0
 
 # Label mapping
 label_mapping = {
@@ -32,6 +89,20 @@ MQTT_BROKER_PREDICTION = "34.101.195.105"
 MQTT_PORT = 1883
 MQTT_TOPIC = "teddy_belt/notifications"
 
+# Alerts wait in this on-disk outbox until the broker acknowledges them
+ALERT_OUTBOX = "alert_outbox.db"
+ALERT_OUTBOX_SIZE = 10000
+ALERT_MAX_INFLIGHT = 20
+
+# Windows without enough motion to be a fall skip the model; thresholds are
+# calibrated with `python activity_gate.py` and the gate is off without them
+gate = load_gate(ACTIVITY_GATE_FILE)
+
+# Per-device sample windows, filled straight from the MQTT callback
+registry = DeviceRegistry(MAX_DATA_POINTS, MAX_DEVICES, DEVICE_IDLE_TIMEOUT,
+                          activity_window=WINDOW_SIZE if gate is not None else None,
+                          max_fill=MAX_GAP_FILL, gap_timeout=GAP_TIMEOUT)
+
 # PostgreSQL database connection settings
 DB_NAME = "fall_detection"
 DB_USER = "root"
@@ -39,111 +110,136 @@ DB_PASSWORD = "123"
 DB_HOST = "localhost"
 DB_PORT = "5432"
 
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        return conn
-    except Exception as e:
-        logging.error(f"Failed to connect to the database: {e}")
-        return None
-
-# Save falling event to the database
-def save_falling_event(label):
-    conn = connect_db()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO fall_events (label) VALUES (%s)",
-                (label,)
-            )
-            conn.commit()
-            cur.close()
-            logging.info(f"Falling event saved: {label}")
-        except Exception as e:
-            logging.error(f"Failed to save falling event to the database: {e}")
-        finally:
-            conn.close()
-
-# Function to process the JSON data and make predictions
-def process_json_data():
-    try:
-        with open('gyro_data.json', 'r') as f:
-            data = json.load(f)
-
-        if len(data) >= 120:  # Ensure we have at least 120 data points
-            logging.info("Data has at least 120 points. Making prediction.")
-            latest_data = data[-120:]  # Get the last 120 data points
-            prediction, predicted_label, predicted_class_index = make_prediction(latest_data)
-            logging.info(f"Prediction: {prediction}, Predicted Class: {predicted_label}")
-            print(f"Prediction: {prediction}, Predicted Class: {predicted_label}")
-
-            # If predicted class index is 2, 3, or 4, publish to MQTT and save to database
-            if predicted_class_index in [2, 3, 4]:
-                msg = ""
-                if predicted_class_index == 2:
-                    msg = "Jatuh Depan Coba Duduk"
-                elif predicted_class_index == 3:
-                    msg = "Jatuh Belakang Coba Duduk"
-                elif predicted_class_index == 4:
-                    msg = "Jatuh Samping Pas Coba Duduk"
-                mqtt_client.publish(MQTT_TOPIC, msg)
-                save_falling_event(predicted_label)
-    except Exception as e:
-        logging.error(f"Error processing JSON data: {e}")
+# Connections kept for writing fall events and the most events waiting to be written
+DB_POOL_SIZE = 2
+EVENT_QUEUE_SIZE = 1000
 
-    # Schedule the next prediction
-    Timer(PREDICTION_INTERVAL, process_json_data).start()
+# Port of the Prometheus /metrics endpoint and interval of the metrics summary log line
+METRICS_PORT = 9100
+METRICS_SUMMARY_INTERVAL = 60
 
-def make_prediction(data):
-    # Extract relevant fields and reshape for prediction
-    gyro_x = [point['gyX'] for point in data]
-    gyro_y = [point['gyY'] for point in data]
-    gyro_z = [point['gyZ'] for point in data]
+SENSOR_MESSAGES = Counter("gyro_messages_total", "Sensor messages received per device")
+SENSOR_SAMPLES = Counter("gyro_samples_total", "Gyro samples received per device")
+DECODE_SECONDS = Histogram("gyro_decode_seconds", "Time to decode a sensor payload and store its samples")
+WINDOW_AGE_SECONDS = Histogram("window_age_seconds", "Time from the newest sample of a window arriving to its prediction being handled")
+PUBLISH_SECONDS = Histogram("alert_publish_seconds", "Time to queue a fall alert in the outbox")
+INVALID_WINDOWS = Counter("invalid_windows_total", "Windows not predicted because they span a gap in the stream")
+DEVICES = Gauge("devices_tracked", "Devices currently held in the registry")
 
-    # Reshape data for model prediction
-    input_data = np.array([gyro_x, gyro_y, gyro_z])
-    input_data = input_data.reshape((1, 3, 120, 1))  # Reshape to (1, 3, 120, 1)
+# Sink for sensor messages received by the ingest core
+def on_sensor_message(msg):
+    try:
+        # Legacy 13-byte sample or framed batch of samples
+        started = time.perf_counter()
+        device_id, seq, sample_rate, samples = decode_payload(msg.payload)
+        device = registry.add_samples(device_id, samples, seq, msg.received, sample_rate)
+        DECODE_SECONDS.observe(time.perf_counter() - started)
+        SENSOR_MESSAGES.inc(device=device_id)
+        SENSOR_SAMPLES.inc(len(samples), device=device_id)
+        if device is not None and device.prediction_due(WINDOW_SIZE, PREDICTION_HOP):
+            count = device.buffer.count
+            if not device.window_valid(WINDOW_SIZE):
+                INVALID_WINDOWS.inc(device=device_id)  # Spans a gap, never feed the model a warped window
+            elif gate is None or gate.passes(device.activity):
+                engine.submit(device_id, device.buffer.window(WINDOW_SIZE), msg.received)
+            else:
+                # Too quiet to be a fall; still counts as a negative window for the alerts
+                alerts.update(device_id, False, None, 0.0, msg.received)
+            device.mark_predicted(count)
+    except ValueError as e:
+        logging.error(f"Failed to decode sensor payload: {e}")
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
 
-    # Make prediction
-    prediction = model.predict(input_data)
-    predicted_class_index = np.argmax(prediction, axis=1)[0]
+# Called by the inference engine with one row of the batch result
+def handle_prediction(device_id, prediction, received):
+    WINDOW_AGE_SECONDS.observe(time.time() - received)
+    predicted_class_index = int(np.argmax(prediction))
     predicted_label = label_mapping[predicted_class_index]
+    logging.info(f"Device {device_id} prediction: {prediction}, Predicted Class: {predicted_label}")
+    print(f"Device {device_id} prediction: {prediction}, Predicted Class: {predicted_label}")
+
+    # Class index 2, 3 or 4 is a fall; the tracker publishes and saves once per fall event
+    alerts.update(device_id, predicted_class_index in [2, 3, 4], predicted_label,
+                  float(prediction[predicted_class_index]), received)
+
+# Queue the notification of a fall event
+def publish_fall_event(event):
+    msg = ""
+    if event.label == label_mapping[2]:
+        msg = "Jatuh Depan Coba Duduk"
+    elif event.label == label_mapping[3]:
+        msg = "Jatuh Belakang Coba Duduk"
+    elif event.label == label_mapping[4]:
+        msg = "Jatuh Samping Pas Coba Duduk"
+    with PUBLISH_SECONDS.time():
+        alert_publisher.publish(event.device_id, event.label, event.confidence,
+                                datetime.fromtimestamp(event.start).isoformat(), message=msg)
+
+# A fall event opened: queue the notification and insert its row right away,
+# which also pushes it to the API stream
+def start_fall_event(event):
+    publish_fall_event(event)
+    event_writer.submit(event.device_id, event.label, event.confidence, datetime.fromtimestamp(event.start))
+
+# A fall event ended: complete its row with the end time and merged windows
+def save_fall_event(event):
+    logging.info(f"Device {event.device_id} fall event: {event.label}, peak confidence {event.confidence:.3f}, "
+                 f"{event.windows} windows over {event.end - event.start:.1f}s")
+    event_writer.complete(event.device_id, datetime.fromtimestamp(event.start), event.label, event.confidence,
+                          datetime.fromtimestamp(event.end), event.windows)
+
+alerts = FallEventTracker(start_fall_event, save_fall_event, ALERT_K, ALERT_N, ALERT_REFRACTORY, ALERT_MAX_GAP)
+
+# Worker processes re-import this module, so nothing below runs in them
+if __name__ == "__main__":
+    # Publisher for fall alerts; it connects (and reconnects) in the background,
+    # alerts queued meanwhile are kept in the outbox
+    alert_publisher = AlertPublisher(MQTT_BROKER_PREDICTION, MQTT_PORT, MQTT_TOPIC, ALERT_OUTBOX,
+                                     ALERT_OUTBOX_SIZE, ALERT_MAX_INFLIGHT)
+    alert_publisher.start()
+
+    # Background writer for fall events; the pool connects lazily, so a database
+    # that is down only delays the writes
+    db_pool = ThreadedConnectionPool(0, DB_POOL_SIZE, dbname=DB_NAME, user=DB_USER,
+                                     password=DB_PASSWORD, host=DB_HOST, port=DB_PORT)
+    event_writer = FallEventWriter(db_pool, EVENT_QUEUE_SIZE)
+    event_writer.start()
+
+    # Start the batched inference engine before any sensor data arrives
+    shadow = ShadowModel(load_runtime(SHADOW_MODEL_PATH), SHADOW_MODEL_PATH) if SHADOW_MODEL_PATH else None
+    if ENSEMBLE_MODELS:
+        model_spec, loader = {'models': ENSEMBLE_MODELS, 'rule': ENSEMBLE_RULE}, load_ensemble
+    else:
+        model_spec, loader = MODEL_PATH, load_reloading_runtime
+    if INFERENCE_WORKERS == 0:
+        engine = BatchInferenceEngine(loader(model_spec), handle_prediction,
+                                      WINDOW_SIZE, MAX_BATCH_SIZE, MAX_BATCH_WAIT, shadow=shadow)
+    else:
+        engine = WorkerPoolEngine(model_spec, handle_prediction, WINDOW_SIZE, MAX_BATCH_SIZE,
+                                  MAX_BATCH_WAIT, workers=INFERENCE_WORKERS, loader=loader, shadow=shadow)
+    engine.start()
 
-    return prediction, predicted_label, predicted_class_index
+    # Receive sensor data through the shared ingest core
+    core = IngestCore()
+    core.add_sink("predictor", on_sensor_message)
+    core.start()
 
-# MQTT setup for publishing messages from prediction
-mqtt_client = mqtt.Client()
+    # Expose pipeline metrics
+    DEVICES.set_function(lambda: len(registry))
+    start_http_server(METRICS_PORT)
+    start_summary_logger(METRICS_SUMMARY_INTERVAL)
 
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        logging.info(f"Connected to MQTT broker at {MQTT_BROKER_PREDICTION}")
-    else:
-        logging.error(f"Failed to connect to MQTT broker, return code {rc}")
-
-mqtt_client.on_connect = on_connect
-
-try:
-    mqtt_client.connect(MQTT_BROKER_PREDICTION, MQTT_PORT, 60)
-    mqtt_client.loop_start()
-except Exception as e:
-    logging.error(f"Failed to connect to MQTT broker: {e}")
-
-# Start the first prediction
-Timer(PREDICTION_INTERVAL, process_json_data).start()
-
-# Keep the script running
-try:
-    while True:
-        time.sleep(0.5)
-except KeyboardInterrupt:
-    logging.info("Script terminated by user.")
-    mqtt_client.loop_stop()
-    mqtt_client.disconnect()
+    # Keep the script running
+    try:
+        while True:
+            time.sleep(0.5)
+            alerts.close_stale(time.time())
+    except KeyboardInterrupt:
+        logging.info("Script terminated by user.")
+        core.stop()
+        engine.stop()
+        alerts.close_all()
+        event_writer.stop()
+        db_pool.closeall()
+        alert_publisher.stop()
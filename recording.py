@@ -0,0 +1,139 @@
+import glob
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import numpy as np
+
+# Append-only binary recording of one gyro capture.
+#
+# Layout of a .gyro file:
+#   magic       4 bytes  b'GYRO'
+#   version     uint8    RECORDING_VERSION
+#   padding     3 bytes
+#   meta_len    uint32   length of the JSON metadata block
+#   metadata    JSON (label, device, start_time, columns, ...), space padded
+#               so samples start on a HEADER_ALIGN boundary
+#   samples     float32 gyX, gyY, gyZ per sample, appended as they arrive
+#
+# The sample count is never stored; it follows from the file size, so a
+# capture that is cut short is still readable up to its last full sample.
+RECORDING_MAGIC = b'GYRO'
+RECORDING_VERSION = 1
+RECORDING_SUFFIX = '.gyro'
+PREAMBLE = struct.Struct('<4sB3xI')
+HEADER_ALIGN = 64
+COLUMNS = ('gyX', 'gyY', 'gyZ')
+SAMPLE_DTYPE = np.dtype('<f4')
+
+class RecordingWriter:
+    def __init__(self, path, label, device_id, start_time=None, **metadata):
+        self.path = path
+        self.count = 0
+        self.metadata = {
+            'label': label,
+            'device': device_id,
+            'start_time': time.time() if start_time is None else start_time,
+            'columns': list(COLUMNS),
+            **metadata,
+        }
+        meta = json.dumps(self.metadata).encode('utf-8')
+        header_size = PREAMBLE.size + len(meta)
+        meta += b' ' * (-header_size % HEADER_ALIGN)
+        self._file = open(path, 'wb')
+        self._file.write(PREAMBLE.pack(RECORDING_MAGIC, RECORDING_VERSION, len(meta)))
+        self._file.write(meta)
+
+    def append(self, samples):
+        # samples is an (n, 3) array of gyX, gyY, gyZ
+        samples = np.asarray(samples, dtype=SAMPLE_DTYPE).reshape(-1, len(COLUMNS))
+        self._file.write(samples.tobytes())
+        self.count += len(samples)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_header(f):
+    magic, version, meta_len = PREAMBLE.unpack(f.read(PREAMBLE.size))
+    if magic != RECORDING_MAGIC:
+        raise ValueError(f"Not a gyro recording: {f.name}")
+    if version != RECORDING_VERSION:
+        raise ValueError(f"Unsupported recording version {version}: {f.name}")
+    metadata = json.loads(f.read(meta_len).decode('utf-8'))
+    return metadata, PREAMBLE.size + meta_len
+
+# Memory-map one recording. Returns (metadata, samples) where samples is a
+# read-only (n, 3) float32 memmap; samples.T gives the gyX/gyY/gyZ columns.
+def read_recording(path):
+    with open(path, 'rb') as f:
+        metadata, offset = read_header(f)
+    count = (os.path.getsize(path) - offset) // (len(COLUMNS) * SAMPLE_DTYPE.itemsize)
+    if count == 0:
+        return metadata, np.empty((0, len(COLUMNS)), dtype=SAMPLE_DTYPE)
+    samples = np.memmap(path, dtype=SAMPLE_DTYPE, mode='r', offset=offset, shape=(count, len(COLUMNS)))
+    return metadata, samples
+
+def load_directory(directory):
+    recordings = []
+    for path in sorted(glob.glob(os.path.join(directory, f"*{RECORDING_SUFFIX}"))):
+        try:
+            recordings.append(read_recording(path))
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to read recording {path}: {e}")
+    return recordings
+
+# Load every recording in a directory into training arrays: samples (N, 3)
+# float32, labels (N,) int64 and offsets (R + 1,) marking where each
+# recording starts, so windows never have to straddle two captures
+def load_training_arrays(directory):
+    recordings = load_directory(directory)
+    lengths = [len(samples) for _, samples in recordings]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    samples = np.empty((offsets[-1], len(COLUMNS)), dtype=SAMPLE_DTYPE)
+    labels = np.empty(offsets[-1], dtype=np.int64)
+    for i, (metadata, recording) in enumerate(recordings):
+        samples[offsets[i]:offsets[i + 1]] = recording
+        labels[offsets[i]:offsets[i + 1]] = metadata['label']
+    return samples, labels, offsets
+
+# Convert a JSON capture written by the old dataset_collect.save_to_file
+def convert_json_file(path, output_dir=None):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if not data:
+        raise ValueError(f"Empty capture: {path}")
+    output_dir = output_dir or os.path.dirname(path)
+    output = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + RECORDING_SUFFIX)
+    samples = np.array([[point['gyX'], point['gyY'], point['gyZ']] for point in data], dtype=SAMPLE_DTYPE)
+    with RecordingWriter(output, data[0]['label'], data[0]['ID'],
+                         start_time=os.path.getmtime(path), source=os.path.basename(path)) as writer:
+        writer.append(samples)
+    return output
+
+def convert_directory(directory, output_dir=None):
+    converted = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        try:
+            converted.append(convert_json_file(path, output_dir))
+            print(f"Converted {path} -> {converted[-1]}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Skipping {path}: {e}")
+    return converted
+
+if __name__ == "__main__":
+    # Usage: python recording.py [datasets_dir] [output_dir]
+    directory = sys.argv[1] if len(sys.argv) > 1 else "datasets"
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    convert_directory(directory, output_dir)
@@ -0,0 +1,375 @@
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from device_registry import DeviceRegistry
+from gyro_protocol import decode_payload, encode_payload
+from inference_engine import BatchInferenceEngine
+from inference_pool import WorkerPoolEngine
+from ingest import IngestCore, GYRO_TOPIC
+from model_runtime import load_runtime
+from recording import load_directory
+
+# Replay harness for the ingest -> predict -> alert pipeline.
+#
+# Recorded captures (datasets/*.gyro or the old datasets/*.json) or
+# synthetic traces are replayed for many devices at once through an
+# IngestCore with no brokers: messages are injected in-process, so the
+# numbers show the cost of the pipeline and not of the network. Each run
+# reports processed samples/s, p50/p99 detection latency (newest sample of
+# a window arriving -> its prediction handled), CPU and peak RSS as JSON.
+#
+# Pipelines:
+#   json-file    the old path: every message rewrites gyro_data.json and a
+#                timer re-reads it every 0.5 s to predict on the last 120
+#                samples
+#   ring-buffer  DeviceRegistry + BatchInferenceEngine, as in
+#                prediction_no_upsample.py
+#   worker-pool  the same with WorkerPoolEngine processes
+#
+# Every (pipeline, speed) run happens in a fresh process so RSS and CPU are
+# not shared between runs. CPU and RSS are reported for the benchmark
+# process and for the inference workers of the worker-pool pipeline
+# separately; worker CPU covers their whole life, model loading included,
+# as getrusage only reports children once they have been joined. Without --model a stub model is used, which
+# measures the pipeline around the model rather than the model itself.
+#
+# Usage: python replay_benchmark.py --devices 50 --speeds 1 10 0 --output bench.json
+PIPELINES = ('json-file', 'ring-buffer', 'worker-pool')
+
+SAMPLE_RATE = 100
+WINDOW_SIZE = 120
+MAX_DATA_POINTS = 1200
+PREDICTION_HOP = 20
+FALL_CLASSES = (2, 3, 4)
+
+# Old path settings, as in the baseline subscribe_no_upsample.py and
+# prediction_no_upsample.py
+JSON_PREDICTION_INTERVAL = 0.5
+
+# How long a run may take to work through what is queued after publishing stops
+DRAIN_TIMEOUT = 5.0
+
+# The uint16 seq field of a frame header, see gyro_protocol.py
+SEQ_FIELD = struct.Struct('<H')
+SEQ_OFFSET = 2
+
+# Cheap stand-in for the classifier with the same input and output shapes
+class StubModel:
+    def __init__(self, classes=5):
+        self.weights = np.random.default_rng(0).normal(size=(3, classes)).astype(np.float32)
+
+    def __call__(self, batch):
+        scores = np.abs(batch).mean(axis=(2, 3)) @ self.weights
+        scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return scores / scores.sum(axis=1, keepdims=True)
+
+# Loader for both the in-process engine and the pool workers
+def load_model(path, backend=None):
+    return StubModel() if path is None else load_runtime(path, backend)
+
+def synthetic_traces(count=8, length=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(length) / SAMPLE_RATE
+    traces = []
+    for _ in range(count):
+        walk = 40 * np.sin(2 * np.pi * rng.uniform(0.8, 2.0) * t)[:, None] * rng.uniform(0, 1, size=3)
+        trace = walk + rng.normal(0, 5, size=(length, 3))
+        fall = rng.integers(0, length - 200)
+        trace[fall:fall + 150] += rng.normal(0, 250, size=(150, 3))
+        traces.append(trace.astype(np.float32))
+    return traces
+
+# (n, 3) float32 arrays from .gyro recordings and old JSON captures in
+# `directory`, or synthetic traces if there are none
+def load_traces(directory=None):
+    traces = []
+    if directory:
+        traces = [np.asarray(samples) for _, samples in load_directory(directory) if len(samples)]
+        for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data:
+                traces.append(np.array([[p['gyX'], p['gyY'], p['gyZ']] for p in data], dtype=np.float32))
+    return [trace for trace in traces if len(trace) >= WINDOW_SIZE] or synthetic_traces()
+
+def device_name(index, legacy):
+    limit = 94 if legacy else 223  # Printable ASCII for legacy IDs, one byte for frames
+    if index >= limit:
+        raise ValueError(f"At most {limit} devices fit in a one-byte device ID")
+    return chr(33 + index)
+
+# Pre-encode one pass over a trace per device, starting at different
+# offsets so devices do not move in lockstep. Frames are encoded with seq 0;
+# replay() numbers them as they are sent.
+def make_streams(traces, devices, frame_size, legacy):
+    streams = []
+    for d in range(devices):
+        trace = traces[d % len(traces)]
+        trace = np.roll(trace, -(d * 37 % len(trace)), axis=0)
+        device_id = device_name(d, legacy)
+        if legacy:
+            payloads = [encode_payload(device_id, sample, legacy=True) for sample in trace]
+        else:
+            payloads = [encode_payload(device_id, trace[i:i + frame_size])
+                        for i in range(0, len(trace) - frame_size + 1, frame_size)]
+        streams.append(payloads)
+    return streams
+
+# Publish every device's next message once per round, paced so each device
+# sends SAMPLE_RATE * speed samples per second. Speed 0 publishes as fast
+# as the pipeline keeps up: it waits while more than `max_backlog` samples
+# are unprocessed, as otherwise the publisher thread alone would saturate
+# the interpreter. Returns the number of samples sent.
+#
+# Frames get their sequence number from a running count of the samples the
+# device sent, so looping over a trace does not look like a restart of the
+# device and break its stream.
+def replay(core, streams, samples_per_message, speed, duration, processed, max_backlog, legacy=False):
+    interval = samples_per_message / (SAMPLE_RATE * speed) if speed else 0
+    sent = 0
+    rounds = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        seq = rounds * samples_per_message % 65536  # Every device sends one message per round
+        for payloads in streams:
+            payload = payloads[rounds % len(payloads)]
+            if not legacy:
+                payload = bytearray(payload)
+                SEQ_FIELD.pack_into(payload, SEQ_OFFSET, seq)
+            core.inject(GYRO_TOPIC, bytes(payload))
+        sent += len(streams) * samples_per_message
+        rounds += 1
+        if interval:
+            delay = start + rounds * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            while sent - processed() > max_backlog and time.perf_counter() - start < duration:
+                time.sleep(0.0005)
+    return sent
+
+class Pipeline:
+    def __init__(self):
+        self.latencies = []
+        self.predictions = 0
+        self.falls = 0
+        self.samples = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, prediction, received):
+        latency = time.time() - received
+        with self._lock:
+            self.latencies.append(latency)
+            self.predictions += 1
+            if int(np.argmax(prediction)) in FALL_CLASSES:
+                self.falls += 1
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def idle(self):
+        return True
+
+# The old path: one shared JSON file rewritten on every message and polled
+# by a timer
+class JsonFilePipeline(Pipeline):
+    def __init__(self, model, directory):
+        super().__init__()
+        self.model = model
+        self.path = os.path.join(directory, "gyro_data.json")
+        self.data_list = []
+        self._stopped = threading.Event()
+
+    def on_message(self, msg):
+        try:
+            device_id, _, _, samples = decode_payload(msg.payload)
+            for gyX, gyY, gyZ in samples.tolist():
+                self.data_list.append({'ID': device_id, 'gyX': gyX, 'gyY': gyY, 'gyZ': gyZ,
+                                       'timestamp': datetime.now().isoformat(), 'received': msg.received})
+                if len(self.data_list) > MAX_DATA_POINTS:
+                    self.data_list.pop(0)
+            with open(self.path, 'w') as f:
+                json.dump(self.data_list, f, indent=4)
+            self.samples += len(samples)
+        except Exception:
+            self.errors += 1
+
+    def process_json_data(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if len(data) >= WINDOW_SIZE:
+                latest_data = data[-WINDOW_SIZE:]
+                input_data = np.array([[point[axis] for point in latest_data] for axis in ('gyX', 'gyY', 'gyZ')])
+                prediction = self.model(input_data.reshape((1, 3, WINDOW_SIZE, 1)).astype(np.float32))[0]
+                self.record(prediction, latest_data[-1]['received'])
+        except (OSError, ValueError):
+            self.errors += 1  # Read the file while it was being rewritten
+
+    def start(self):
+        def run():
+            while not self._stopped.wait(JSON_PREDICTION_INTERVAL):
+                self.process_json_data()
+        self._thread = threading.Thread(target=run, name="json-predictor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+# The new path, as wired in prediction_no_upsample.py
+class RingBufferPipeline(Pipeline):
+    def __init__(self, engine_factory):
+        super().__init__()
+        self.registry = DeviceRegistry(MAX_DATA_POINTS, max_devices=1024)
+        self.engine = engine_factory(self.on_result)
+
+    def on_message(self, msg):
+        try:
+            device_id, seq, sample_rate, samples = decode_payload(msg.payload)
+            device = self.registry.add_samples(device_id, samples, seq, msg.received, sample_rate)
+            self.samples += len(samples)
+            if device is not None and device.prediction_due(WINDOW_SIZE, PREDICTION_HOP):
+                count = device.buffer.count
+                if device.window_valid(WINDOW_SIZE):
+                    self.engine.submit(device_id, device.buffer.window(WINDOW_SIZE), msg.received)
+                device.mark_predicted(count)
+        except ValueError:
+            self.errors += 1
+
+    def on_result(self, device_id, prediction, received):
+        self.record(prediction, received)
+
+    def start(self):
+        self.engine.start()
+
+    def stop(self):
+        self.engine.stop()
+
+    def idle(self):
+        return self.engine.pending() == 0
+
+def make_pipeline(config, directory):
+    model_path, backend = config['model'], config['backend']
+    if config['pipeline'] == 'json-file':
+        return JsonFilePipeline(load_model(model_path, backend), directory)
+    if config['pipeline'] == 'ring-buffer':
+        model = load_model(model_path, backend)
+        return RingBufferPipeline(lambda on_result: BatchInferenceEngine(model, on_result, WINDOW_SIZE))
+    if config['pipeline'] == 'worker-pool':
+        return RingBufferPipeline(lambda on_result: WorkerPoolEngine(
+            model_path, on_result, WINDOW_SIZE, workers=config['workers'], backend=backend, loader=load_model))
+    raise ValueError(f"Unknown pipeline {config['pipeline']!r}, expected one of {PIPELINES}")
+
+def percentile_ms(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 3) if values else None
+
+def run_benchmark(config):
+    legacy = config['legacy']
+    samples_per_message = 1 if legacy else config['frame_size']
+    streams = make_streams(load_traces(config['data']), config['devices'], samples_per_message, legacy)
+
+    with tempfile.TemporaryDirectory() as directory:
+        pipeline = make_pipeline(config, directory)
+        core = IngestCore(brokers=[])
+        sink = core.add_sink("replay", pipeline.on_message, queue_size=config['queue_size'])
+        pipeline.start()
+        core.start()
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        sent = replay(core, streams, samples_per_message, config['speed'], config['duration'],
+                      lambda: pipeline.samples, config['queue_size'] * samples_per_message // 2, legacy)
+        deadline = time.perf_counter() + DRAIN_TIMEOUT
+        while (sink.queue.qsize() or not pipeline.idle()) and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        core.stop()
+        pipeline.stop()  # Joins the worker processes, if any
+        workers = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+    worker_cpu = workers.ru_utime + workers.ru_stime
+    return {
+        **{key: config[key] for key in ('pipeline', 'speed', 'devices', 'duration', 'legacy', 'model')},
+        'frame_size': samples_per_message,
+        'elapsed': round(elapsed, 3),
+        'samples_sent': sent,
+        'samples_processed': pipeline.samples,
+        'samples_per_s': round(pipeline.samples / elapsed, 1),
+        'messages_dropped': sink.dropped,
+        'predictions': pipeline.predictions,
+        'fall_predictions': pipeline.falls,
+        'errors': pipeline.errors,
+        'latency_p50_ms': percentile_ms(pipeline.latencies, 50),
+        'latency_p99_ms': percentile_ms(pipeline.latencies, 99),
+        'cpu_percent': round(100 * (cpu + worker_cpu) / elapsed, 1),
+        'cpu_percent_main': round(100 * cpu / elapsed, 1),
+        'cpu_percent_workers': round(100 * worker_cpu / elapsed, 1),
+        'max_rss_mb': round(end_usage.ru_maxrss / 1024, 1),  # ru_maxrss is in KiB on Linux
+        'max_worker_rss_mb': round(workers.ru_maxrss / 1024, 1),  # Largest single worker
+    }
+
+def _run_child(config, results):
+    results.put(run_benchmark(config))
+
+# Run one benchmark in a fresh process; not a Pool, whose daemonic workers
+# could not start the worker-pool pipeline's own processes
+def run_isolated(config):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_run_child, args=(config, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay gyro traces through the prediction pipelines")
+    parser.add_argument("--pipelines", nargs="+", choices=PIPELINES, default=['json-file', 'ring-buffer'])
+    parser.add_argument("--speeds", nargs="+", type=float, default=[1, 10, 0],
+                        help="replay speed multipliers; 0 replays as fast as possible")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of publishing per run")
+    parser.add_argument("--data", default=None, help="directory of .gyro or .json captures (default: synthetic)")
+    parser.add_argument("--frame-size", type=int, default=20, help="samples per framed message")
+    parser.add_argument("--legacy", action="store_true", help="send one 13-byte message per sample")
+    parser.add_argument("--queue-size", type=int, default=1000, help="ingest queue size of the pipeline sink")
+    parser.add_argument("--model", default=None, help="model file to run instead of the stub model")
+    parser.add_argument("--backend", default=None, help="model backend, see model_runtime.py")
+    parser.add_argument("--workers", type=int, default=None, help="processes for the worker-pool pipeline")
+    parser.add_argument("--output", default=None, help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    for pipeline in args.pipelines:
+        for speed in args.speeds:
+            config = {'pipeline': pipeline, 'speed': speed, 'devices': args.devices, 'duration': args.duration,
+                      'data': args.data, 'frame_size': args.frame_size, 'legacy': args.legacy,
+                      'queue_size': args.queue_size, 'model': args.model, 'backend': args.backend,
+                      'workers': args.workers}
+            print(f"Running {pipeline} at {'max' if speed == 0 else f'{speed:g}x'} speed...", file=sys.stderr)
+            results.append(run_isolated(config))
+
+    output = json.dumps({'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
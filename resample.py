@@ -0,0 +1,64 @@
+import numpy as np
+
+# Fields carried by the JSON gyro messages that get interpolated
+FIELDS = ('millis', 'gyX', 'gyY', 'gyZ', 'temp')
+
+RECORD_DTYPE = np.dtype([
+    ('millis', np.int64),
+    ('gyX', np.float64),
+    ('gyY', np.float64),
+    ('gyZ', np.float64),
+    ('temp', np.float64),
+    ('ID', 'U8'),
+])
+
+# Turn a list of per-sample dicts into an (n_fields, n_samples) float array
+def to_columns(data, fields=FIELDS):
+    return np.array([[point[field] for field in fields] for point in data], dtype=np.float64).T
+
+# Linearly interpolate every row of `columns` from the source positions onto
+# `target_length` evenly spaced positions spanning the same range, in one
+# pass for all rows. Without `positions` the samples are assumed to be
+# evenly spaced (index positions).
+def resample_columns(columns, target_length, positions=None):
+    columns = np.asarray(columns, dtype=np.float64)
+    source_length = columns.shape[1]
+    if positions is None:
+        positions = np.arange(source_length, dtype=np.float64)
+    else:
+        positions = np.asarray(positions, dtype=np.float64)
+    if source_length == 1:
+        return np.repeat(columns, target_length, axis=1)
+
+    targets = np.linspace(positions[0], positions[-1], target_length)
+    left = np.clip(np.searchsorted(positions, targets, side='right') - 1, 0, source_length - 2)
+    span = positions[left + 1] - positions[left]
+    # Repeated timestamps would divide by zero; take the left sample there
+    frac = np.divide(targets - positions[left], span, out=np.zeros_like(targets), where=span > 0)
+    return columns[:, left] * (1 - frac) + columns[:, left + 1] * frac
+
+# Resample a batch of model windows (N, channels, window, 1) along time to
+# (N, channels, length, 1) float32, in one pass for the whole batch
+def resample_windows(batch, length):
+    n, channels, window, _ = batch.shape
+    rows = resample_columns(batch.reshape(n * channels, window), length)
+    return rows.reshape(n, channels, length, 1).astype(np.float32)
+
+# Resample a list of gyro dicts to `target_length` points and return a
+# structured array with RECORD_DTYPE. With use_timestamps=True the samples
+# are placed at their `millis` values instead of at evenly spaced indices.
+def upsample_data(data, target_length, use_timestamps=False):
+    columns = to_columns(data)
+    positions = columns[0] if use_timestamps else None
+    resampled = resample_columns(columns, target_length, positions)
+
+    records = np.empty(target_length, dtype=RECORD_DTYPE)
+    records['ID'] = data[0]['ID']
+    for row, field in enumerate(FIELDS):
+        records[field] = resampled[row]  # millis is truncated to an integer like int()
+    return records
+
+# Materialize a structured array as plain dicts, only for the JSON boundary
+def records_to_dicts(records):
+    names = records.dtype.names
+    return [dict(zip(names, values)) for values in records.tolist()]
@@ -0,0 +1,51 @@
+import threading
+import numpy as np
+
+# Fixed-size, NumPy-backed sample buffer for one device.
+#
+# Every sample is written twice, at column i and column i + capacity, so the
+# most recent `length` samples always sit in one contiguous slice and
+# window() can return a view without copying. A returned view of length L
+# stays untouched for the next (capacity - L) appends, which is why the
+# buffer is sized well above the model window.
+class RingBuffer:
+    def __init__(self, capacity, channels=3, dtype=np.float32):
+        self.capacity = capacity
+        self.channels = channels
+        self._data = np.zeros((channels, 2 * capacity), dtype=dtype)
+        self._head = 0  # Next write position in [0, capacity)
+        self.count = 0  # Total samples ever written
+        self._lock = threading.Lock()
+
+    def append(self, sample):
+        with self._lock:
+            self._data[:, self._head] = sample
+            self._data[:, self._head + self.capacity] = sample
+            self._head = (self._head + 1) % self.capacity
+            self.count += 1
+
+    def append_many(self, samples):
+        # samples is an (n, channels) array, e.g. one decoded MQTT frame
+        samples = np.asarray(samples)
+        with self._lock:
+            n = len(samples)
+            kept = samples[-self.capacity:].T
+            index = (self._head + n - kept.shape[1] + np.arange(kept.shape[1])) % self.capacity
+            self._data[:, index] = kept
+            self._data[:, index + self.capacity] = kept
+            self._head = (self._head + n) % self.capacity
+            self.count += n
+
+    def window(self, length):
+        # Return a (channels, length) view of the latest samples, or None
+        # if fewer than `length` samples have arrived yet
+        if length > self.capacity:
+            raise ValueError(f"Window length {length} exceeds capacity {self.capacity}")
+        with self._lock:
+            if self.count < length:
+                return None
+            end = self._head + self.capacity
+            return self._data[:, end - length:end]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
@@ -0,0 +1,40 @@
+-- Schema for the fall_detection database
+
+CREATE TABLE IF NOT EXISTS fall_events (
+    id SERIAL PRIMARY KEY,
+    label TEXT NOT NULL,
+    event_time TIMESTAMP NOT NULL DEFAULT now()
+);
+
+-- Written by event_writer.FallEventWriter
+ALTER TABLE fall_events ADD COLUMN IF NOT EXISTS device_id TEXT;
+ALTER TABLE fall_events ADD COLUMN IF NOT EXISTS confidence REAL;
+ALTER TABLE fall_events ADD COLUMN IF NOT EXISTS window_time TIMESTAMP;
+
+-- A row covers one fall: window_time/end_time are its first and last
+-- positive window and `windows` how many were merged by alert_tracker. It
+-- is inserted when the fall starts and updated, found by (device_id,
+-- window_time), once it ended
+ALTER TABLE fall_events ADD COLUMN IF NOT EXISTS end_time TIMESTAMP;
+ALTER TABLE fall_events ADD COLUMN IF NOT EXISTS windows INTEGER NOT NULL DEFAULT 1;
+CREATE INDEX IF NOT EXISTS fall_events_device_window_time_idx ON fall_events (device_id, window_time);
+
+-- Keyset pagination in /fall_events walks (event_time, id); the device index
+-- serves the ?device= filter
+CREATE INDEX IF NOT EXISTS fall_events_event_time_id_idx ON fall_events (event_time, id);
+CREATE INDEX IF NOT EXISTS fall_events_device_event_time_idx ON fall_events (device_id, event_time, id);
+
+-- Every new fall event is announced on the fall_events channel, which feeds
+-- the /fall_events/stream endpoint of the API. Only the insert at the start
+-- of a fall notifies, so stream clients get each fall once, as it starts;
+-- its completed row is read from /fall_events
+CREATE OR REPLACE FUNCTION notify_fall_event() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('fall_events', row_to_json(NEW)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS fall_events_notify ON fall_events;
+CREATE TRIGGER fall_events_notify AFTER INSERT ON fall_events
+    FOR EACH ROW EXECUTE FUNCTION notify_fall_event();
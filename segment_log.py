@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import time
+
+# Append-only NDJSON log split into segments.
+#
+# Records are appended as one JSON object per line to the active segment
+# in `directory`; the segment is rotated once it grows past `max_bytes` or
+# gets older than `max_age` seconds. index.json lists every segment with
+# the number of records and bytes it held when the index was last written
+# (on rotation, on close and every `index_interval` seconds), so counting
+# records never parses the log: count_records() sums the index and only
+# counts newlines in whatever was appended after it.
+#
+# fsync policy: 'always' syncs after every append, 'interval' at most every
+# `fsync_interval` seconds, 'never' leaves it to the OS.
+INDEX_FILE = "index.json"
+SEGMENT_SUFFIX = ".ndjson"
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+class SegmentLog:
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, max_age=3600, fsync='interval',
+                 fsync_interval=1.0, index_interval=5.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync!r}, expected one of {FSYNC_POLICIES}")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.index_interval = index_interval
+        os.makedirs(directory, exist_ok=True)
+        self.segments = read_index(directory)
+        self._file = None
+        self._segment = None
+        self._last_sync = self._last_index = time.monotonic()
+        self._open_segment()
+
+    def append(self, records):
+        if self._segment_full():
+            self._rotate()
+        lines = "".join(json.dumps(record, separators=(',', ':')) + "\n" for record in records).encode('utf-8')
+        self._file.write(lines)
+        self._segment['records'] += len(records)
+        self._segment['bytes'] += len(lines)
+        self._segment['end'] = time.time()
+
+        now = time.monotonic()
+        if self.fsync == 'always' or (self.fsync == 'interval' and now - self._last_sync >= self.fsync_interval):
+            self._sync()
+        if now - self._last_index >= self.index_interval:
+            self._file.flush()
+            self._write_index()
+
+    def close(self):
+        if self._file is not None:
+            if self.fsync != 'never':
+                self._sync()
+            else:
+                self._file.flush()
+            self._file.close()
+            self._file = None
+            self._write_index()
+
+    def _segment_full(self):
+        return (self._segment['bytes'] >= self.max_bytes
+                or time.time() - self._segment['start'] >= self.max_age)
+
+    def _open_segment(self):
+        now = time.time()
+        name = f"segment-{int(now * 1000)}-{len(self.segments):06d}{SEGMENT_SUFFIX}"
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        self._segment = {'name': name, 'records': 0, 'bytes': 0, 'start': now, 'end': now}
+        self.segments.append(self._segment)
+        self._write_index()
+
+    def _rotate(self):
+        self.close()
+        self._open_segment()
+        logging.info(f"Rotated segment log {self.directory} to {self._segment['name']}")
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def _write_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({'segments': self.segments}, f)
+        os.replace(path + ".tmp", path)
+        self._last_index = time.monotonic()
+
+def read_index(directory):
+    try:
+        with open(os.path.join(directory, INDEX_FILE), 'r') as f:
+            return json.load(f)['segments']
+    except FileNotFoundError:
+        return []
+
+def count_newlines(path, offset):
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            count += chunk.count(b'\n')
+    return count
+
+# Number of complete records in the log, from the index plus a newline count
+# of anything appended after the index was written
+def count_records(directory):
+    total = 0
+    for segment in read_index(directory):
+        path = os.path.join(directory, segment['name'])
+        total += segment['records']
+        try:
+            if os.path.getsize(path) > segment['bytes']:
+                total += count_newlines(path, segment['bytes'])
+        except FileNotFoundError:
+            total -= segment['records']  # Segment removed by retention
+    return total
+
+def read_records(directory):
+    for segment in read_index(directory):
+        path = os.path.join(directory, segment['name'])
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.endswith(b'\n'):  # Skip a torn final line
+                    yield json.loads(line)
@@ -0,0 +1,124 @@
+import numpy as np
+from metrics import Counter, Gauge
+
+GAPS = Counter("gyro_gaps_total", "Gaps in a device stream, by whether they were filled or broke the window")
+MISSING_SAMPLES = Counter("gyro_missing_samples_total", "Samples lost in gaps (estimated for legacy devices)")
+FILLED_SAMPLES = Counter("gyro_filled_samples_total", "Missing samples filled by interpolation")
+BURSTS = Counter("gyro_bursts_total", "Runs of samples that arrived much faster than the sample rate")
+ARRIVAL_INTERVAL = Gauge("gyro_arrival_interval_seconds", "Smoothed time between samples arriving, per device")
+
+# Sample rate assumed for legacy 13-byte messages, which do not carry one
+NOMINAL_SAMPLE_RATE = 100
+
+# Arrival timing and a reconstructed, uniform time base for one device.
+#
+# The sensor samples at a fixed rate, so the time of sample i is
+# offset + i / rate, and arrival times only add network delay and jitter.
+# The offset is the smallest (arrival - i / rate) seen, the sample that
+# got through fastest, allowed to creep up by OFFSET_CREEP seconds per
+# second so a device clock that runs slow is followed.
+#
+# Gaps are exact for framed messages, from the sequence numbers: up to
+# `max_fill` missing samples are filled in by the caller, longer gaps (or a
+# device restart) break the stream. Legacy messages have no sequence
+# number, so a silence longer than `gap_timeout` breaks the stream, with
+# the lost samples estimated from the silence. After a break the time base
+# starts over.
+#
+# A burst is a run of samples arriving at under BURST_FACTOR of the sample
+# interval, e.g. a device flushing what it buffered while offline.
+OFFSET_CREEP = 0.001
+BURST_FACTOR = 0.25
+INTERVAL_SMOOTHING = 0.05
+
+class StreamClock:
+    def __init__(self, device_id, max_fill=10, gap_timeout=0.25, rate=NOMINAL_SAMPLE_RATE):
+        self.device_id = device_id
+        self.max_fill = max_fill
+        self.gap_timeout = gap_timeout
+        self.rate = rate
+        self.count = 0  # Samples on the time base, filled ones included
+        self.offset = None
+        self.last_seq = None
+        self.last_received = None
+        self.interval = None  # Smoothed seconds between arriving samples
+        self.in_burst = False
+        self.missed = 0
+        self.gaps = 0
+        self.bursts = 0
+
+    # Account for `n` samples that arrived at `received`. Returns
+    # (fill, broken): how many missing samples the caller should
+    # interpolate in front of them, and whether the stream broke before
+    # them.
+    def observe(self, n, received, seq=None, sample_rate=None):
+        if sample_rate:
+            self.rate = sample_rate
+        fill, broken, missing = 0, False, 0
+        if seq is not None:
+            if self.last_seq is not None:
+                gap = (seq - self.last_seq - 1) % 65536
+                if 0 < gap < 32768:
+                    missing = gap
+                    if gap <= self.max_fill:
+                        fill = gap
+                    else:
+                        broken = True
+                elif gap >= 32768:  # Reordering or a device restart
+                    broken = True
+            self.last_seq = (seq + n - 1) % 65536
+        elif self.last_received is not None and received - self.last_received > self.gap_timeout:
+            missing = max(0, round((received - self.last_received) * self.rate) - n)
+            broken = True
+
+        if missing:
+            self.missed += missing
+            self.gaps += 1
+            MISSING_SAMPLES.inc(missing, device=self.device_id)
+            GAPS.inc(device=self.device_id, kind="broken" if broken else "filled")
+            if fill:
+                FILLED_SAMPLES.inc(fill, device=self.device_id)
+        elif broken:
+            GAPS.inc(device=self.device_id, kind="broken")
+        self._track_arrivals(n, received, broken)
+
+        self.count += fill + n
+        candidate = received - self.count / self.rate
+        if self.offset is None or broken:
+            self.offset = candidate
+        else:
+            creep = (received - self.last_received) * OFFSET_CREEP
+            self.offset = min(self.offset + creep, candidate)
+        self.last_received = received
+        return fill, broken
+
+    def _track_arrivals(self, n, received, broken):
+        if self.last_received is None or broken:
+            self.in_burst = False
+            return
+        per_sample = (received - self.last_received) / n
+        self.interval = per_sample if self.interval is None else \
+            self.interval + INTERVAL_SMOOTHING * (per_sample - self.interval)
+        ARRIVAL_INTERVAL.set(self.interval, device=self.device_id)
+        if per_sample < BURST_FACTOR / self.rate:
+            if not self.in_burst:
+                self.in_burst = True
+                self.bursts += 1
+                BURSTS.inc(device=self.device_id)
+        elif per_sample >= 2 * BURST_FACTOR / self.rate:
+            self.in_burst = False
+
+    # Reconstructed time (seconds since the epoch) of sample number `index`,
+    # counting from 1 like `count`
+    def sample_time(self, index):
+        return self.offset + index / self.rate
+
+    # Reconstructed times of the latest `n` samples
+    def sample_times(self, n):
+        return self.offset + np.arange(self.count - n + 1, self.count + 1) / self.rate
+
+# `fill` samples linearly interpolated between `last` and `first`, both
+# excluded, as an (fill, 3) array
+def interpolate_gap(last, first, fill):
+    steps = np.arange(1, fill + 1, dtype=np.float32)[:, None] / (fill + 1)
+    return (last + (first - last) * steps).astype(np.float32)
@@ -1,13 +1,16 @@
-import paho.mqtt.client as mqtt
 import json
 import logging
 import os
 from datetime import datetime
-import struct
+from gyro_protocol import decode_payload
+from stream_timing import StreamClock
+from ingest import IngestCore
+from metrics import install_rate_limited_logging
 
 # Setup logging
 logging.basicConfig(filename='mqtt_client.log', level=logging.DEBUG, 
                     format='%(asctime)s %(levelname)s %(message)s')
+install_rate_limited_logging()
 
 # Path to save the JSON file
 SAVE_FILE = "gyro_data.json"
@@ -28,28 +31,34 @@ if os.path.exists(SAVE_FILE):
 else:
     data_list = []
 
-# Callback when the client connects to the broker
-def on_connect(client, userdata, flags, rc):
-    logging.info(f"Connected with result code {rc}")
-    client.subscribe("fall-detection/sensor/gyro")
+# Per-device time base, so samples are stamped with when they were taken
+# rather than when they arrived
+clocks = {}
 
-# Callback when a message is received
-def on_message(client, userdata, msg):
+# Sink for every message received by the ingest core
+def on_message(msg):
     logging.info(f"Message received on topic {msg.topic}")
     try:
-        # Unpack the binary data
-        payload = msg.payload
-        if len(payload) == 13:
-            device_id = chr(payload[0])
-            gyX, gyY, gyZ = struct.unpack('fff', payload[1:])
-            
+        # Decode the binary data (legacy 13-byte sample or framed batch)
+        device_id, seq, sample_rate, samples = decode_payload(msg.payload)
+        clock = clocks.get(device_id)
+        if clock is None:
+            clock = clocks[device_id] = StreamClock(device_id)
+        fill, broken = clock.observe(len(samples), msg.received, seq, sample_rate)
+        if fill or broken:
+            logging.warning(f"Device {device_id}: gap before sample {clock.count - len(samples) + 1}, "
+                            f"{clock.missed} samples missed so far")
+        times = clock.sample_times(len(samples))
+        
+        for (gyX, gyY, gyZ), sample_time in zip(samples.tolist(), times.tolist()):
+            timestamp = datetime.fromtimestamp(sample_time).isoformat()
             # Prepare the data point as a dictionary
             data_point = {
                 'ID': device_id,
                 'gyX': gyX,
                 'gyY': gyY,
                 'gyZ': gyZ,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': timestamp
             }
             
             # Print the received data (optional)
@@ -57,17 +66,15 @@ def on_message(client, userdata, msg):
             
             # Add the new data point to the list
             data_list.append(data_point)
-            
-            # Ensure the list does not exceed MAX_DATA_POINTS
-            if len(data_list) > MAX_DATA_POINTS:
-                data_list.pop(0)
-            
-            # Save the updated data list to the JSON file
-            save_to_file(data_list)
-        else:
-            logging.error("Received payload has unexpected length")
-    except struct.error as e:
-        logging.error(f"Failed to unpack binary data: {e}")
+        
+        # Ensure the list does not exceed MAX_DATA_POINTS
+        if len(data_list) > MAX_DATA_POINTS:
+            del data_list[:len(data_list) - MAX_DATA_POINTS]
+        
+        # Save the updated data list to the JSON file
+        save_to_file(data_list)
+    except ValueError as e:
+        logging.error(f"Failed to decode binary data: {e}")
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
 
@@ -81,15 +88,9 @@ def save_to_file(data):
         logging.error(f"Failed to save data to file: {e}")
         print(f"Failed to save data to file: {e}")
 
-# Create an MQTT client instance
-client = mqtt.Client()
-
-# Assign the callback functions
-client.on_connect = on_connect
-client.on_message = on_message
-
-# Connect to the MQTT broker
-client.connect("34.143.200.120", 1883, 60)
+# Hand messages to the sink through the shared ingest core
+core = IngestCore()
+core.add_sink("file-recorder", on_message)
 
-logging.info("Starting MQTT client loop")
-client.loop_forever()
+logging.info("Starting MQTT ingest")
+core.run_forever()